@@ -1,9 +1,17 @@
 from abc import ABC, abstractmethod
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
 import glob
 import json
+import os
+import re
+import threading
 import pandas as pd
 import h5py
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from livenodes import Ports_collection
 
@@ -15,6 +23,166 @@ class Ports_out(Ports_collection):
     ts: Port_Timeseries = Port_Timeseries("TimeSeries")
     channels: Port_ListUnique_Str = Port_ListUnique_Str("Channel Names")
     annot: Port_Timeseries = Port_Timeseries("Annotation")
+    annot_labels: Port_ListUnique_Str = Port_ListUnique_Str("Annotation Labels")
+
+
+# File extensions of Arrow IPC and Parquet files, see `file_format` setting of `Out_h5_csv`
+_TABLE_EXTENSIONS = ('.arrow', '.feather', '.parquet')
+
+
+class _Table_rows:
+    """Channel columns of an Arrow table, sliced row-wise into (samples, channels) arrays like a "data" dataset."""
+
+    def __init__(self, table, channels):
+        self.table = table
+        self.channels = channels
+
+    def __len__(self):
+        return self.table.num_rows
+
+    @property
+    def shape(self):
+        return (self.table.num_rows, len(self.channels))
+
+    @property
+    def dtype(self):
+        return np.result_type(*[self.table.schema.field(c).type.to_pandas_dtype() for c in self.channels])
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(len(self))
+        part = self.table.slice(start, max(0, stop - start))
+        if len(self.channels) == 0:
+            return np.empty((part.num_rows, 0))
+        return np.column_stack([part[c].to_numpy() for c in self.channels])
+
+    def with_channels(self, channels):
+        return _Table_rows(self.table, channels)
+
+
+class _Parquet_rows(_Table_rows):
+    """Channel columns of a Parquet file like `_Table_rows`, but decoding only the row groups overlapping each slice.
+
+    The row groups of the last slice are kept, such that consecutive block
+    reads decode each row group once.
+    """
+
+    def __init__(self, parquet_file, channels):
+        self.parquet_file = parquet_file
+        self.channels = channels
+        metadata = parquet_file.metadata
+        self.offsets = np.cumsum([0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+        self.groups, self.table = None, None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self), len(self.channels))
+
+    @property
+    def dtype(self):
+        schema = self.parquet_file.schema_arrow
+        return np.result_type(*[schema.field(c).type.to_pandas_dtype() for c in self.channels])
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(len(self))
+        if stop <= start or len(self.channels) == 0:
+            return np.empty((max(0, stop - start), len(self.channels)), dtype=self.dtype if self.channels else np.float64)
+
+        groups = range(np.searchsorted(self.offsets, start, side='right') - 1, np.searchsorted(self.offsets, stop, side='left'))
+        if groups != self.groups:
+            self.groups, self.table = groups, self.parquet_file.read_row_groups(groups, columns=self.channels)
+        part = self.table.slice(start - self.offsets[groups.start], stop - start)
+        return np.column_stack([part[c].to_numpy() for c in self.channels])
+
+    def with_channels(self, channels):
+        return _Parquet_rows(self.parquet_file, channels)
+
+
+class _Selection:
+    """Rows and columns selected from a dataset, sliced row-wise like the dataset itself, such that only the selection is read from disk."""
+
+    def __init__(self, dataset, rows, columns):
+        self.dataset = dataset
+        self.columns = columns
+        n_samples = len(dataset)
+        start, stop = (None, None) if rows is None else rows
+        self.start = min(start or 0, n_samples)
+        self.stop = max(self.start, n_samples if stop is None else min(stop, n_samples))
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def shape(self):
+        return (len(self), self.dataset.shape[1] if self.columns is None else len(self.columns))
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(len(self))
+        rows = slice(self.start + start, self.start + stop)
+        if self.columns is None:
+            return self.dataset[rows]
+        if isinstance(self.dataset, h5py.Dataset):
+            # hyperslab selections need increasing and unique indices
+            unique, inverse = np.unique(self.columns, return_inverse=True)
+            return self.dataset[rows, unique.tolist()][:, inverse.reshape(-1)]
+        return self.dataset[rows][:, self.columns]
+
+
+class _Recording_cache:
+    """Per process LRU cache of decoded recordings.
+
+    Entries are keyed by the path and modification time of all files of a
+    recording, such that changed files are read again. Cached arrays are
+    read-only, as they are shared between reads and nodes.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(segments):
+        return tuple((f, os.stat(f).st_mtime_ns, os.stat(csv_file).st_mtime_ns if os.path.exists(csv_file := f.replace(".h5", ".csv")) else None) for f in segments)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, recording, max_bytes):
+        data, channels, annot = recording
+        n_bytes = data.nbytes + np.asarray(annot).nbytes
+        if n_bytes > max_bytes:
+            return
+        for arr in (data, annot):
+            if isinstance(arr, np.ndarray):
+                arr.flags.writeable = False
+
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (recording, n_bytes)
+            self.n_bytes += n_bytes
+            while self.n_bytes > max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+
+_cache = _Recording_cache()
 
 
 class Abstract_in_h5_csv(Producer_async, ABC):
@@ -26,19 +194,129 @@ class Abstract_in_h5_csv(Producer_async, ABC):
     category = "Data Source"
     description = ""
 
-    def __init__(self, name="In h5 CSV", files='data', meta={}, **kwargs):
+    def __init__(
+        self,
+        name="In h5 CSV",
+        files='data',
+        meta={},
+        categorical=False,
+        cache_bytes=0,
+        index=None,
+        select_channels=None,
+        select_start=None,
+        select_stop=None,
+        unit="samples",
+        shard_index=0,
+        shard_count=1,
+        **kwargs,
+    ):
         super(Producer_async, self).__init__(name, **kwargs)
         self.files = files
         self.meta = meta
         self.channels = meta.get('channels')
+        self.categorical = categorical
+        self.cache_bytes = cache_bytes
+        self.index = index
+        self.select_channels = select_channels
+        self.select_start = select_start
+        self.select_stop = select_stop
+        self.unit = unit
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+        if not 0 <= self.shard_index < self.shard_count:
+            raise ValueError(f"Shard index {self.shard_index} must be within 0 and shard count {self.shard_count}.")
+        if self.unit not in ("samples", "seconds"):
+            raise ValueError(f'Unknown unit "{self.unit}", must be one of "samples" or "seconds".')
+        if any(x is not None and x < 0 for x in (select_start, select_stop)):
+            # rows are selected from recordings of yet unknown length, thus bounds relative to the end are not supported
+            raise ValueError(f"Selected rows from {select_start} to {select_stop} must not be negative.")
+
+        # selected rows in samples, pushed down to the file reads
+        self.rows = None
+        if select_start is not None or select_stop is not None:
+            scale = 1
+            if self.unit == "seconds":
+                if meta.get('sample_rate') is None:
+                    raise ValueError('Selecting rows in seconds requires the sample_rate meta parameter.')
+                scale = meta['sample_rate']
+            self.rows = tuple(None if x is None else int(round(x * scale)) for x in (select_start, select_stop))
+
+        # selected columns by name or index, pushed down to the file reads
+        self.columns = None
+        if select_channels is not None:
+            self.columns = list(select_channels)
+            if self.channels is not None and self.channels != [""]:
+                # meta channel names name all channels of the files, thus names are resolved against them and the names are selected alike
+                self.columns = [self._column_index(self.channels, c, "meta channels") for c in select_channels]
+                self.channels = [self.channels[i] for i in self.columns]
+
+        # label table of categorical mode, maps annotation strings to codes in order of appearance
+        self.label_codes = {}
 
     def _settings(self):
-        return {"files": self.files, "meta": self.meta}
+        return {
+            "files": self.files,
+            "meta": self.meta,
+            "categorical": self.categorical,
+            "cache_bytes": self.cache_bytes,
+            "index": self.index,
+            "select_channels": self.select_channels,
+            "select_start": self.select_start,
+            "select_stop": self.select_stop,
+            "unit": self.unit,
+            "shard_index": self.shard_index,
+            "shard_count": self.shard_count,
+        }
 
     @abstractmethod
     async def _async_run(self):
         raise NotImplementedError
 
+    async def _prefetched(self, generator, depth):
+        """Runs `generator` on a background thread, keeping up to `depth` items ahead of the consumer."""
+        if depth <= 0:
+            for item in generator:
+                yield item
+            return
+
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        # free slots of read ahead items, released once the consumer takes an item
+        slots = threading.Semaphore(depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                if slots.acquire(timeout=0.1):
+                    try:
+                        loop.call_soon_threadsafe(items.put_nowait, item)
+                    except RuntimeError:
+                        # event loop already closed
+                        return False
+                    return True
+            return False
+
+        def run():
+            try:
+                for item in generator:
+                    if not put(item):
+                        return
+            except Exception as err:
+                # re-raised on the event loop
+                put(err)
+            put(None)
+
+        threading.Thread(target=run, name=f"{self.name} prefetch", daemon=True).start()
+        try:
+            while (item := await items.get()) is not None:
+                slots.release()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
     def _overwrite_channels(self, channels, n_channels):
         new_channels = [str(x) for x in list(range(n_channels))]  # Default values
         if self.channels is not None and self.channels != [""]:  # Single empty string in Smart Studio equivalent to nothing set
@@ -53,32 +331,474 @@ class Abstract_in_h5_csv(Producer_async, ABC):
         return new_channels
 
     @staticmethod
-    def _read_data(f):
+    def _column_index(channels, column, source):
+        if isinstance(column, str):
+            if column not in channels:
+                raise ValueError(f'Selected channel "{column}" not found in {source} {channels}.')
+            return channels.index(column)
+        return int(column)
+
+    def _selected_samples(self, n_samples):
+        """Number of samples of a recording with `n_samples` samples within the selected rows."""
+        if self.rows is None:
+            return n_samples
+        start = min(self.rows[0] or 0, n_samples)
+        stop = n_samples if self.rows[1] is None else min(self.rows[1], n_samples)
+        return max(0, stop - start)
+
+    def _encode_annotation(self, annot):
+        """Maps annotation strings to integer codes of the label table.
+
+        Returns the codes and whether new labels were added to the table.
+        """
+        labels, inverse = np.unique(np.asarray(annot, dtype=str), return_inverse=True)
+        n_labels = len(self.label_codes)
+        for label in labels:
+            self.label_codes.setdefault(str(label), len(self.label_codes))
+        codes = np.array([self.label_codes[str(label)] for label in labels], dtype=np.int64)
+        return codes[inverse.reshape(-1)], len(self.label_codes) > n_labels
+
+    def _glob_recordings(self):
+        """Expands the `files` glob pattern into recordings.
+
+        Each recording is a list of .h5 files. Segments written by a rotating
+        `Out_h5_csv` node are grouped in the order listed in their manifest,
+        all other files are recordings of their own.
+        """
+        recordings, seen = [], set()
+        for f in glob.glob(self.files):
+            if f in seen:
+                continue
+            segments = self._read_manifest(f)
+            seen.update(segments)
+            recordings.append(segments)
+        return self._shard(recordings)
+
+    def _shard(self, recordings):
+        """Selects the recordings of this node's shard, if `shard_count` is above 1.
+
+        Recordings are assigned greedily, largest first, to the shard with the
+        fewest bytes so far, such that shards are balanced by size. Ties are
+        broken by path, thus all shards assign the same recordings alike
+        regardless of glob order. Recordings keep their glob order within a
+        shard.
+        """
+        if self.shard_count <= 1:
+            return recordings
+
+        sizes = [sum(os.path.getsize(f) for f in segments) for segments in recordings]
+        loads = [0] * self.shard_count
+        shard = {}
+        for size, segments in sorted(zip(sizes, recordings), key=lambda x: (-x[0], x[1])):
+            i = loads.index(min(loads))
+            loads[i] += size
+            shard[tuple(segments)] = i
+        return [segments for segments in recordings if shard[tuple(segments)] == self.shard_index]
+
+    @staticmethod
+    def _read_manifest(f):
+        if (match := re.match(r'(.*)\.part\d+\.(h5|arrow|feather|parquet)$', f)) and os.path.exists(manifest_file := f"{match.group(1)}.manifest.json"):
+            with open(manifest_file, 'r') as manifest_f:
+                segments = json.load(manifest_f).get('segments', [])
+            folder = os.path.dirname(f)
+            # segments may be listed before they are written, e.g. if the recording is still running
+            return [p for s in segments if os.path.exists(p := os.path.join(folder, s))] or [f]
+        return [f]
+
+    @classmethod
+    def _read_recording(cls, segments, columns=None, rows=None):
+        """Reads all segments of a recording as one continuous recording, optionally only the selected columns and rows."""
+        segment_rows = cls._segment_rows(segments, rows)
+        if len(segments) == 1:
+            return cls._read_data(segments[0], columns, segment_rows[0])
+
+        parts = [part for part in map(cls._read_data, segments, [columns] * len(segments), segment_rows) if part[0].size > 0]
+        if len(parts) == 0:
+            return np.array([[]]), [], np.array([[]])
+
+        data = np.concatenate([part[0] for part in parts], axis=0)
+        channels = parts[0][1]
+        annot = []
+        if any(len(part[2]) > 0 for part in parts):
+            # segments without annotation file are treated as not annotated
+            annot = np.concatenate([part[2] if len(part[2]) > 0 else np.full(len(part[0]), "") for part in parts])
+        return data, channels, annot
+
+    def _load_recording(self, segments):
+        """Reads a recording like `_read_recording`, but served from and added to the recording cache if `cache_bytes` is set."""
+        if self.cache_bytes <= 0:
+            return self._read_recording(segments, self.columns, self.rows)
+
+        key = _cache.key(segments) + ((None if self.columns is None else tuple(self.columns), self.rows),)
+        if (recording := _cache.get(key)) is None:
+            recording = self._read_recording(segments, self.columns, self.rows)
+            _cache.put(key, recording, self.cache_bytes)
+        return recording
+
+    def _load_blocks(self, segments, block_size):
+        """Reads a recording block-wise like `_read_blocks`.
+
+        Recordings that fit the `cache_bytes` budget are loaded as a whole via
+        the recording cache and sliced into blocks instead.
+        """
+        if self.cache_bytes <= 0 or self._data_nbytes(segments) > self.cache_bytes:
+            yield from self._read_blocks(segments, block_size, self.columns, self.rows)
+            return
+
+        ts, channels, annot = self._load_recording(segments)
+        if ts.size == 0:
+            return
+        for start in range(0, len(ts), block_size):
+            yield ts[start : start + block_size], channels, annot[start : start + block_size]
+
+    def _recording_infos(self, recordings):
+        """Looks up sample count, dtype, channels, annotation labels and size of each recording in the index file.
+
+        Files missing from the index or modified since are read and added to
+        the index file. Files that cannot be read are counted as empty, but
+        left out of the index file, such that they are read again on the next
+        run. The channels of all recordings are validated against
+        each other, or the `meta` channel names if given. Returns None if no
+        `index` file is set.
+        """
+        if self.index is None:
+            return None
+
+        entries = {}
+        if os.path.exists(self.index):
+            with open(self.index, 'r') as f:
+                entries = json.load(f).get('files', {})
+
+        changed = False
+        infos = []
+        for segments in recordings:
+            segment_infos = []
+            for f in segments:
+                path = os.path.abspath(f)
+                mtime = list(_Recording_cache.key([f])[0][1:])
+                if (entry := entries.get(path)) is None or entry['mtime_ns'] != mtime:
+                    if (info := self._file_info(f)) is None:
+                        # e.g. a file on a network mount failing temporarily
+                        changed = entries.pop(path, None) is not None or changed
+                        entry = {'n_samples': 0, 'n_channels': 0, 'dtype': None, 'channels': [], 'labels': [], 'n_bytes': 0}
+                    else:
+                        entries[path] = entry = {'mtime_ns': mtime, **info}
+                        changed = True
+                segment_infos.append(entry)
+            infos.append(
+                {
+                    'n_samples': sum(info['n_samples'] for info in segment_infos),
+                    'n_bytes': sum(info['n_bytes'] for info in segment_infos),
+                    'n_channels': segment_infos[0]['n_channels'],
+                    'dtype': segment_infos[0]['dtype'],
+                    'channels': segment_infos[0]['channels'],
+                    'labels': sorted(set().union(*(info['labels'] for info in segment_infos))),
+                }
+            )
+
+        for path in [path for path in entries if not os.path.exists(path)]:
+            del entries[path]
+            changed = True
+        if changed:
+            # replace atomically, such that concurrent readers never see a partial index
+            with open(tmp_file := f"{self.index}.{os.getpid()}.tmp", 'w') as f:
+                json.dump({'files': entries}, f)
+            os.replace(tmp_file, self.index)
+
+        self._validate_channels(recordings, infos)
+        return infos
+
+    def _validate_channels(self, recordings, infos):
+        expected = None
+        if (meta_channels := self.meta.get('channels')) is not None and meta_channels != [""]:
+            expected = len(meta_channels)
+
+        first = next(((segments, info) for segments, info in zip(recordings, infos) if info['n_samples'] > 0), None)
+        for segments, info in zip(recordings, infos):
+            if info['n_samples'] == 0:
+                continue
+            if expected is not None and info['n_channels'] != expected:
+                raise ValueError(f"Number of channels of {segments[0]} is {info['n_channels']}, but should be {expected} as given in meta channels {meta_channels}.")
+            # files without channel names are only checked for the number of channels
+            names_differ = info['channels'] and first[1]['channels'] and info['channels'] != first[1]['channels']
+            if expected is None and (info['n_channels'] != first[1]['n_channels'] or names_differ):
+                raise ValueError(f"Channels {info['channels']} of {segments[0]} differ from channels {first[1]['channels']} of {first[0][0]}.")
+
+    @classmethod
+    def _file_info(cls, f):
+        """Reads sample count, dtype, channels, annotation labels and size of a file. Returns None if the file cannot be read."""
+        try:
+            with cls._open_data(f) as (dataset, channels, runs):
+                return {
+                    'n_samples': len(dataset),
+                    'n_channels': int(dataset.shape[1]),
+                    'dtype': str(dataset.dtype),
+                    'channels': [str(x) for x in channels],
+                    'labels': [] if runs is None else sorted(set(np.asarray(runs[2]).astype(str).tolist())),
+                    'n_bytes': os.path.getsize(f),
+                }
+        except (OSError, TypeError, pa.ArrowException):
+            print('Could not open file, skipping', f)
+            return None
+
+    @classmethod
+    def _n_samples(cls, segments):
+        n_samples = 0
+        for f in segments:
+            try:
+                if f.endswith(_TABLE_EXTENSIONS):
+                    n_samples += cls._table_info(f)[1]
+                    continue
+                with h5py.File(f, 'r') as data_file:
+                    n_samples += len(data_file['data'])
+            except (OSError, KeyError, pa.ArrowException):
+                pass
+        return n_samples
+
+    @classmethod
+    def _data_nbytes(cls, segments):
+        n_bytes = 0
+        for f in segments:
+            try:
+                if f.endswith(_TABLE_EXTENSIONS):
+                    schema, n_rows = cls._table_info(f)
+                    n_bytes += n_rows * sum(np.dtype(field.type.to_pandas_dtype()).itemsize for field in schema if field.name != "annot")
+                    continue
+                with h5py.File(f, 'r') as data_file:
+                    dataset = data_file['data']
+                    n_bytes += dataset.size * dataset.dtype.itemsize
+            except (OSError, KeyError, pa.ArrowException):
+                pass
+        return n_bytes
+
+    @staticmethod
+    def _read_table(f):
+        """Reads an Arrow IPC file. Arrow IPC files are memory-mapped, such that columns are zero-copy views into the map."""
+        return pa.ipc.open_file(pa.memory_map(f, 'r')).read_all()
+
+    @staticmethod
+    def _table_info(f):
+        """Reads schema and number of rows of an Arrow IPC or Parquet file without reading its columns."""
+        if f.endswith('.parquet'):
+            parquet_file = pq.ParquetFile(f)
+            return parquet_file.schema_arrow, parquet_file.metadata.num_rows
+        reader = pa.ipc.open_file(pa.memory_map(f, 'r'))
+        return reader.schema, sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+    @staticmethod
+    def _table_annotation_runs(table):
+        """Reads annotation runs from the "annot" column of a table. Returns None if the table is not annotated."""
+        if "annot" not in table.column_names or table.num_rows == 0:
+            return None
+        column = table["annot"]
+        if not pa.types.is_dictionary(column.type):
+            column = column.dictionary_encode()
+        # record batches and row groups may have dictionaries of their own
+        column = column.unify_dictionaries().combine_chunks()
+
+        codes = column.indices.to_numpy(zero_copy_only=False)
+        changes = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        starts = np.concatenate([[0], changes])
+        ends = np.concatenate([changes, [len(codes)]])
+        return starts, ends, column.dictionary.to_numpy(zero_copy_only=False).astype(str)[codes[starts]]
+
+    @classmethod
+    def _segment_rows(cls, segments, rows):
+        """Splits selected rows of a recording into the rows selected from each of its segments."""
+        if rows is None or len(segments) == 1:
+            return [rows] * len(segments)
+
+        segment_rows, offset = [], 0
+        for f in segments:
+            n_samples = cls._n_samples([f])
+            start = min(max(0, (rows[0] or 0) - offset), n_samples)
+            stop = n_samples if rows[1] is None else min(max(0, rows[1] - offset), n_samples)
+            segment_rows.append((start, stop))
+            offset += n_samples
+        return segment_rows
+
+    @classmethod
+    def _select(cls, f, dataset, channels, runs, columns, rows):
+        """Restricts a dataset, its channel names and annotation runs to the selected columns and rows."""
+        if dataset is None or (columns is None and rows is None):
+            return dataset, channels, runs
+
+        if columns is not None:
+            n_channels = dataset.shape[1]
+            columns = [cls._column_index(channels, c, f"channels of {f}") for c in columns]
+            if any(not -n_channels <= c < n_channels for c in columns):
+                raise ValueError(f"Selected channels {columns} out of range for {n_channels} channels of {f}.")
+            columns = [c % n_channels for c in columns]
+            # files without channel names keep the default names of the selected channels
+            channels = [channels[c] for c in columns] if channels else [str(c) for c in columns]
+            if isinstance(dataset, _Table_rows):
+                # only the selected columns are stacked
+                dataset, columns = dataset.with_channels(channels), None
+
+        if rows is not None and runs is not None:
+            start = rows[0] or 0
+            runs = (np.asarray(runs[0]) - start, np.asarray(runs[1]) - start, runs[2])
+        return _Selection(dataset, rows, columns), channels, runs
+
+    @classmethod
+    @contextmanager
+    def _open_data(cls, f, columns=None, rows=None, annotation=True):
+        """Opens a data file, yielding its data as sliceable dataset along with channel names and annotation runs.
+
+        With `columns` and `rows`, only the selected channels and samples are
+        included and read on slicing. Without `annotation`, the annotation
+        runs are not read and None instead.
+        """
+        if f.endswith('.parquet'):
+            # row groups are decoded on slicing, only the annotation column is read upfront
+            with pq.ParquetFile(f, memory_map=True) as parquet_file:
+                channels = [c for c in parquet_file.schema_arrow.names if c != "annot"]
+                runs = None
+                if annotation and "annot" in parquet_file.schema_arrow.names:
+                    runs = cls._table_annotation_runs(parquet_file.read(columns=["annot"]))
+                yield cls._select(f, _Parquet_rows(parquet_file, channels), channels, runs, columns, rows)
+            return
+
+        if f.endswith(_TABLE_EXTENSIONS):
+            table = cls._read_table(f)
+            channels = [c for c in table.column_names if c != "annot"]
+            yield cls._select(f, _Table_rows(table, channels), channels, cls._table_annotation_runs(table) if annotation else None, columns, rows)
+            return
+
+        with h5py.File(f, 'r') as data_file:
+            dataset = data_file.get('data')
+            channels = cls._read_channels(f, dataset)
+            runs = cls._read_annotation_runs(f, data_file) if annotation else None
+
+            # slices of a mapped dataset are views instead of copies
+            if (mapped := cls._map_dataset(f, dataset)) is not None:
+                dataset = mapped
+            yield cls._select(f, dataset, channels, runs, columns, rows)
+
+    @staticmethod
+    def _read_channels(f, dataset=None):
+        """Reads channel names from the dataset attributes or, for files without them, from the .json file."""
+        if dataset is not None and "channels" in dataset.attrs:
+            return [str(x) for x in dataset.attrs["channels"]]
+
+        channels = []
+        if glob.glob(json_file := f.replace(".h5", ".json")):
+            with open(json_file, 'r') as json_f:
+                entries = json.load(json_f)
+                if "channels" in entries:
+                    channels = entries.get("channels")
+        return channels
+
+    @staticmethod
+    def _map_dataset(f, dataset):
+        """Maps a contiguous, unfiltered dataset read-only from disk. Returns None if the dataset cannot be mapped.
+
+        Reads from the map are zero-copy and served from the page cache,
+        which is shared by all processes reading the same file.
+        """
+        if dataset is None or dataset.chunks is not None or dataset.external is not None or dataset.dtype.kind not in "biuf" or dataset.size == 0:
+            return None
+        if (offset := dataset.id.get_offset()) is None:
+            return None
+        return np.memmap(f, mode='r', dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+
+    @staticmethod
+    def _expand_annotation(starts, ends, acts, n_samples):
+        """Expands annotation runs into an array with one annotation string per sample, with "" for samples not covered by any run."""
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, n_samples)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), 0, n_samples)
+        labels = np.concatenate([[""], np.asarray(acts).astype(str)])
+
+        # runs do not overlap, thus marking each run's label index at its start and end yields the per sample index as cumulative sum
+        codes = np.zeros(n_samples + 1, dtype=np.int64)
+        run_idx = np.arange(1, len(starts) + 1)
+        np.add.at(codes, starts, run_idx)
+        np.add.at(codes, ends, -run_idx)
+        return labels[np.cumsum(codes[:-1])]
+
+    @staticmethod
+    def _read_annotation_runs(f, data_file):
+        """Reads annotation runs as start, end and label arrays. Returns None if the file is not annotated."""
+        # prefer annotation stored in the same file, see `annot_in_h5` setting of `Out_h5_csv`
+        if 'annot' in data_file and 'annot_labels' in data_file:
+            runs = data_file['annot'][:]
+            labels = data_file['annot_labels'].asstr()[:]
+            return (runs[:, 0], runs[:, 1], labels[runs[:, 2]]) if len(runs) > 0 else None
+
+        if glob.glob(csv_file := f.replace(".h5", ".csv")):
+            if (ref := pd.read_csv(csv_file, delimiter=',')).size > 0:
+                return ref['start'].to_numpy(), ref['end'].to_numpy(), ref['act'].to_numpy()
+        return None
+
+    @staticmethod
+    def _read_data(f, columns=None, rows=None):
         try:
-            with h5py.File(f, 'r') as data_file:
-                data = data_file.get('data')[:]  # Load into mem
-
-            channels = []
-            if glob.glob(json_file := f.replace(".h5", ".json")):
-                with open(json_file, 'r') as json_f:
-                    entries = json.load(json_f)
-                    if "channels" in entries:
-                        channels = entries.get("channels")
-
-            annot = []
-            if glob.glob(csv_file := f.replace(".h5", ".csv")):
-                if (ref := pd.read_csv(csv_file, delimiter=',')).size > 0:
-                    last_end = 0
-                    rows = ref.iterrows()
-                    for _, row in rows:
-                        annot.append([""] * (row['start'] - last_end))
-                        annot.append([str(row['act'])] * (row['end'] - row['start']))
-                        last_end = row['end']
-                    annot.append([""] * (len(data) - last_end))
-                    annot = list(np.concatenate(annot))
+            with Abstract_in_h5_csv._open_data(f, columns, rows) as (dataset, channels, runs):
+                data = dataset[:]  # Load into mem
 
+            annot = [] if runs is None else Abstract_in_h5_csv._expand_annotation(*runs, len(data))
             return data, channels, annot
 
-        except (OSError, TypeError):
+        except (OSError, TypeError, pa.ArrowException):
             print('Could not open file, skipping', f)
             return np.array([[]]), [], np.array([[]])
+
+    @classmethod
+    def _read_blocks(cls, segments, block_size, columns=None, rows=None):
+        """Reads a recording block-wise, yielding data, channels and annotation of at most `block_size` samples.
+
+        Only the current block is held in memory. All blocks but the last
+        contain exactly `block_size` samples, also across segment boundaries.
+        The annotation of each block is expanded from the annotation runs of
+        its file and is empty if no segment of the recording is annotated.
+        """
+        # segments without annotation are treated as not annotated if any other segment is annotated
+        fill_annot = len(segments) > 1 and any(map(cls._is_annotated, segments))
+
+        carry = None
+        for f, segment_rows in zip(segments, cls._segment_rows(segments, rows)):
+            try:
+                with cls._open_data(f, columns, segment_rows) as (dataset, channels, runs):
+                    if runs is None and fill_annot:
+                        runs = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=str))
+
+                    start = 0
+                    while start < len(dataset):
+                        ts = dataset[start : start + block_size - (0 if carry is None else len(carry[0]))]
+                        annot = None if runs is None else cls._expand_annotation(runs[0] - start, runs[1] - start, runs[2], len(ts))
+                        start += len(ts)
+
+                        if carry is not None:
+                            ts, annot = cls._concat_blocks(carry, (ts, annot))
+                            carry = None
+                        if len(ts) < block_size:
+                            # remainder of this file, filled up by the next segment
+                            carry = (ts, annot)
+                            continue
+                        yield ts, channels, [] if annot is None else annot
+            except (OSError, TypeError, pa.ArrowException):
+                print('Could not open file, skipping', f)
+
+        if carry is not None:
+            yield carry[0], channels, [] if carry[1] is None else carry[1]
+
+    @staticmethod
+    def _is_annotated(f):
+        try:
+            if f.endswith(_TABLE_EXTENSIONS):
+                return "annot" in Abstract_in_h5_csv._table_info(f)[0].names
+            if glob.glob(f.replace(".h5", ".csv")):
+                return True
+            with h5py.File(f, 'r') as data_file:
+                return 'annot' in data_file and len(data_file['annot']) > 0
+        except (OSError, pa.ArrowException):
+            return False
+
+    @staticmethod
+    def _concat_blocks(first, second):
+        ts = np.concatenate([first[0], second[0]], axis=0)
+        if first[1] is None and second[1] is None:
+            return ts, None
+        # blocks without annotation are treated as not annotated
+        annot = [a if a is not None else np.full(len(d), "") for d, a in (first, second)]
+        return ts, np.concatenate(annot)
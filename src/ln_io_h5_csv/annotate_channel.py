@@ -2,14 +2,15 @@ import numpy as np
 
 from livenodes.node import Node
 
-from ln_ports import Ports_ts_channels, Port_List_Str, Port_Timeseries
+from ln_ports import Ports_ts_channels, Port_List_Str, Port_List_Any, Port_ListUnique_Str, Port_Timeseries
 from livenodes import Ports_collection
 
 
 class Ports_out(Ports_collection):
     ts: Port_Timeseries = Port_Timeseries("TimeSeries")
     channels: Port_List_Str = Port_List_Str("Channel Names")
-    annot: Port_List_Str = Port_List_Str("Annotation")
+    annot: Port_List_Any = Port_List_Any("Annotation")
+    annot_labels: Port_ListUnique_Str = Port_ListUnique_Str("Annotation Labels")
 
 
 class Annotate_channel(Node):
@@ -29,12 +30,18 @@ class Annotate_channel(Node):
     Using a regular signal data channel may produce nonsensical results. The
     channel must also be a part of those input via the Channel Names port.
 
+    In `categorical` mode, the integer codes 0 and 1 are sent instead of the
+    target names, and the target names are sent once via the Annotation
+    Labels port.
+
     Attributes
     ----------
     channel_name : str
         Name of the input channel used to generate annotation.
     targets : List of str
         List of two annotation target names. Further list elements are ignored.
+    categorical : bool
+        Whether to send integer label codes instead of target names.
 
     Ports In
     --------
@@ -50,9 +57,12 @@ class Annotate_channel(Node):
     channels : Port_ListUnique_Str
         List of channel names without the specified annotation channel. Sent
         only once on the first batch.
-    annot : Port_List_Str
+    annot : Port_List_Any
         List of annotation strings corresponding to data batch, with one string
-        per data sample.
+        per data sample. Integer label codes in `categorical` mode.
+    annot_labels : Port_ListUnique_Str
+        List of the two target names, where the label code is the index into
+        the list. Sent only once on the first batch in `categorical` mode.
     """
 
     ports_in = Ports_ts_channels()
@@ -63,11 +73,12 @@ class Annotate_channel(Node):
 
     example_init = {'name': 'Channel Annotation', 'channel_name': 'Pushbutton', 'targets': ['Pressed', 'Released']}
 
-    def __init__(self, channel_name, targets, name="Channel Annotation", **kwargs):
+    def __init__(self, channel_name, targets, name="Channel Annotation", categorical=False, **kwargs):
         super().__init__(name=name, **kwargs)
 
         self.channel_name = channel_name
         self.targets = targets
+        self.categorical = categorical
         self.name = name
 
         self.idx = None
@@ -77,6 +88,7 @@ class Annotate_channel(Node):
             "name": self.name,
             "channel_name": self.channel_name,
             "targets": self.targets,
+            "categorical": self.categorical,
         }
 
     def _should_process(self, ts=None, channels=None):
@@ -86,7 +98,12 @@ class Annotate_channel(Node):
         if channels is not None:
             self.idx = np.array(channels) == self.channel_name
             self.ret_accu(np.array(channels)[~self.idx], port=self.ports_out.channels)
+            if self.categorical:
+                self.ret_accu(list(self.targets[:2]), port=self.ports_out.annot_labels)
 
         self.ret_accu(ts[:, ~self.idx], port=self.ports_out.ts)
-        self.ret_accu(np.where(ts[:, self.idx].flatten() > 0, self.targets[1], self.targets[0]), port=self.ports_out.annot)
+        if self.categorical:
+            self.ret_accu((ts[:, self.idx].flatten() > 0).astype(np.int64), port=self.ports_out.annot)
+        else:
+            self.ret_accu(np.where(ts[:, self.idx].flatten() > 0, self.targets[1], self.targets[0]), port=self.ports_out.annot)
         return self.ret_accumulated()
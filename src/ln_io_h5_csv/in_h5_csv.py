@@ -1,11 +1,14 @@
 import asyncio
-import glob
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import time
+import h5py
 import numpy as np
 import os
 
 from livenodes import Ports_collection
 
-from .abstract_in_h5_csv import Abstract_in_h5_csv
+from .abstract_in_h5_csv import Abstract_in_h5_csv, _cache
 from ln_ports import Port_Timeseries, Port_Number, Port_ListUnique_Str
 
 
@@ -13,18 +16,21 @@ class Ports_out(Ports_collection):
     ts: Port_Timeseries = Port_Timeseries("TimeSeries")
     channels: Port_ListUnique_Str = Port_ListUnique_Str("Channel Names")
     annot: Port_Timeseries = Port_Timeseries("Annotation")
+    annot_labels: Port_ListUnique_Str = Port_ListUnique_Str("Annotation Labels")
     percent: Port_Number = Port_Number("Percent")
 
 
 class In_h5_csv(Abstract_in_h5_csv):
     """Reads and sends HDF5/.h5 data and corresponding .csv annotation.
 
-    Each batch contains the entire dataset of a file. For custom batch sizes
-    and real-time simulation use the `In_playback_h5_csv` node with its
-    `emit_at_once` and `sample_rate` settings instead.
+    Each batch contains the entire dataset of a file, unless limited via
+    `max_samples_per_batch`. For custom batch sizes and real-time simulation
+    use the `In_playback_h5_csv` node with its `emit_at_once` and
+    `sample_rate` settings instead.
 
     Channels sent via the Channel Names port are named by priority:
         - List of names from meta parameter if given.
+        - List of names from the "data" dataset attributes if found.
         - List of names from valid JSON file if found.
         - Otherwise ascending from "0".
 
@@ -32,14 +38,25 @@ class In_h5_csv(Abstract_in_h5_csv):
     content is sent via the Annotation port. .h5 and .csv files created via
     the `Out_h5_csv` node automatically follow this format.
 
+    Segmented recordings written by `Out_h5_csv` with one of its `rotate_*`
+    settings are read and sent as one continuous recording.
+
     After each file is processed, the Percent port is also updated accordingly.
     One common usage example is triggering model training once all files are
     sent.
 
+    With the `follow` setting, files are tailed instead, e.g. while being
+    written by an `Out_h5_csv` node in SWMR mode. The node then polls each file
+    and only sends newly appended samples, until the file stops growing for
+    `follow_timeout` seconds. Annotation is not sent in this mode, which only
+    supports HDF5/.h5 files and ignores the channel and sample selection.
+
     Attributes
     ----------
     files : str
-        glob pattern for files to include. Should end with ".h5" extension.
+        glob pattern for files to include. Should end with ".h5" extension,
+        or ".arrow"/".parquet" for files written with the `file_format`
+        setting of `Out_h5_csv`.
         Common examples are single files ("../data/data.h5") or all files in a
         directory ("../data/*.h5").
     meta : dict
@@ -50,6 +67,65 @@ class In_h5_csv(Abstract_in_h5_csv):
         * 'channel_names' : list of unique str, optional
             List of channel names for `channels` port. Overwrites default names
             or those loaded from JSON file.
+    categorical : bool
+        Whether to send integer label codes instead of annotation strings via
+        the Annotation port. The label table is sent via the Annotation
+        Labels port whenever new labels are encountered, usually only once.
+    cache_bytes : int
+        Memory budget in bytes of the per process cache of decoded
+        recordings, such that restarting a graph does not read the same
+        recordings again. If 0, no recordings are cached.
+    follow : bool
+        Whether to tail files and only send newly appended samples.
+    poll_interval : float
+        Time in seconds between checks for new samples in `follow` mode.
+    follow_timeout : float, optional
+        Time in seconds without new samples after which a file is considered
+        complete in `follow` mode. If not set, the file is tailed until the
+        node is stopped.
+    workers : int
+        Number of workers loading files in parallel. Files are still sent in
+        glob order. If 0, files are read one after another.
+    backend : str
+        Worker pool for `workers`, either "threads" or "processes". HDF5 access
+        is serialized within a process, so "processes" usually scales better
+        for compressed files.
+    prefetch : int, optional
+        Maximum number of files loaded ahead of the one being sent, which
+        bounds memory usage. Defaults to `workers`.
+    index : str, optional
+        Path of an index file, which records sample count, dtype, channels,
+        annotation labels and size of each file. It is built on the first run
+        and only files modified since are read again. The channels of all
+        files are then validated before sending and Percent is updated by
+        samples sent instead of files.
+    select_channels : list of str or int, optional
+        Channels to read, by name or index. Names are resolved against the
+        `meta` channel names if given, otherwise against those of each file.
+        Only the selected columns are read from disk and sent, in the given
+        order.
+    select_start : int or float, optional
+        First sample to read from each recording, in `unit`.
+    select_stop : int or float, optional
+        Sample to stop reading each recording at (exclusive), in `unit`.
+        Only the selected rows are read from disk.
+    unit : str
+        Unit of `select_start` and `select_stop`, either "samples" or "seconds". Seconds
+        require the 'sample_rate' meta parameter.
+    shard_index : int
+        Index of the shard to read, from 0 to `shard_count` - 1.
+    shard_count : int
+        Number of shards the recordings matched by `files` are split into,
+        e.g. one per worker of a distributed job. Each recording is read by
+        exactly one shard. Recordings are assigned deterministically and
+        balanced by file size, such that all shards get about the same amount
+        of data. If 1, all recordings are read.
+    max_samples_per_batch : int, optional
+        Maximum number of samples per batch. Files are then read and sent in
+        chunks of this size with the corresponding annotation, such that
+        memory usage does not depend on the file size. Percent is updated
+        by samples sent instead of files. Files are read one after another,
+        i.e. `workers` is not used.
 
     Ports Out
     ---------
@@ -61,39 +137,242 @@ class In_h5_csv(Abstract_in_h5_csv):
     annot : Port_TimeSeries, single channel
         Annotation strings corresponding to data samples. Only sent if valid
         .csv annotation file found. Otherwise empty.
+    annot_labels : Port_ListUnique_Str
+        Label table for the codes sent via the Annotation port, where the
+        code is the index into the list. Only sent in `categorical` mode.
     percent : Port_Number
-        Percentage of files sent so far. Float values from 0.0 to 1.0.
+        Percentage of files, or samples if `max_samples_per_batch` or `index`
+        is set, sent so far. Float values from 0.0 to 1.0. With `shard_count`,
+        the percentage of the files of this shard.
 
     Raises
     ------
+    ValueError
+        If `backend` is not one of "threads" or "processes".
     ValueError
         If number of channel names from meta parameter or JSON file does not
         equal actual number of channels.
+    ValueError
+        If `index` is set and the channels of files differ from each other.
+    ValueError
+        If a selected channel is not found, `unit` is unknown or
+        `select_start` or `select_stop` is negative.
+    ValueError
+        If `shard_index` is not within 0 and `shard_count`.
     """
 
     ports_out = Ports_out()
 
     example_init = {'name': 'In h5 CSV', 'files': 'data/*.h5', 'meta': {'channels': [""]}}
 
-    def __init__(self, name="In h5 CSV", files='data', meta={}, **kwargs):
-        super().__init__(name, files, meta, **kwargs)
+    def __init__(
+        self,
+        name="In h5 CSV",
+        files='data',
+        meta={},
+        categorical=False,
+        cache_bytes=0,
+        index=None,
+        select_channels=None,
+        select_start=None,
+        select_stop=None,
+        unit="samples",
+        shard_index=0,
+        shard_count=1,
+        follow=False,
+        poll_interval=0.05,
+        follow_timeout=None,
+        workers=0,
+        backend="threads",
+        prefetch=None,
+        max_samples_per_batch=None,
+        **kwargs,
+    ):
+        super().__init__(
+            name,
+            files,
+            meta,
+            categorical=categorical,
+            cache_bytes=cache_bytes,
+            index=index,
+            select_channels=select_channels,
+            select_start=select_start,
+            select_stop=select_stop,
+            unit=unit,
+            shard_index=shard_index,
+            shard_count=shard_count,
+            **kwargs,
+        )
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.follow_timeout = follow_timeout
+        self.workers = workers
+        self.backend = backend
+        self.prefetch = prefetch
+        self.max_samples_per_batch = max_samples_per_batch
+
+        if self.backend not in ("threads", "processes"):
+            raise ValueError(f'Unknown backend "{self.backend}", must be one of "threads" or "processes".')
+
+    def _settings(self):
+        return {
+            "files": self.files,
+            "meta": self.meta,
+            "categorical": self.categorical,
+            "cache_bytes": self.cache_bytes,
+            "index": self.index,
+            "select_channels": self.select_channels,
+            "select_start": self.select_start,
+            "select_stop": self.select_stop,
+            "unit": self.unit,
+            "shard_index": self.shard_index,
+            "shard_count": self.shard_count,
+            "follow": self.follow,
+            "poll_interval": self.poll_interval,
+            "follow_timeout": self.follow_timeout,
+            "workers": self.workers,
+            "backend": self.backend,
+            "prefetch": self.prefetch,
+            "max_samples_per_batch": self.max_samples_per_batch,
+        }
+
+    async def _follow(self, f):
+        """Tails the "data" dataset of a file, yielding only newly appended rows along with the dataset."""
+        last_change = time.monotonic()
+        data_file = None
+        try:
+            while not self.stop_event.is_set():
+                if data_file is None:
+                    try:
+                        # fails until the writer created the dataset and switched to SWMR mode
+                        data_file = h5py.File(f, 'r', libver='latest', swmr=True)
+                        dataset = data_file['data']
+                        n_read = 0
+                    except (OSError, KeyError):
+                        if data_file is not None:
+                            data_file.close()
+                            data_file = None
+                else:
+                    dataset.refresh()
+                    if (n := dataset.shape[0]) > n_read:
+                        yield dataset[n_read:n], dataset
+                        n_read, last_change = n, time.monotonic()
+                        continue
+
+                if self.follow_timeout is not None and time.monotonic() - last_change >= self.follow_timeout:
+                    break
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            if data_file is not None:
+                data_file.close()
+
+    async def _loaded_recordings(self, recordings):
+        """Loads recordings on the worker pool, yielding them along with their segments in order while keeping up to `prefetch` recordings loaded ahead."""
+        if self.workers <= 0:
+            for segments in recordings:
+                yield segments, self._load_recording(segments)
+            return
+
+        executor = (ThreadPoolExecutor if self.backend == "threads" else ProcessPoolExecutor)(max_workers=self.workers)
+        pending = deque()
+        try:
+            for segments in recordings:
+                pending.append((segments, self._submit_recording(executor, segments)))
+                # the recording being sent plus those loaded ahead
+                if len(pending) > (self.prefetch if self.prefetch is not None else self.workers):
+                    segments, future = pending.popleft()
+                    yield segments, await future
+            while pending:
+                segments, future = pending.popleft()
+                yield segments, await future
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit_recording(self, executor, segments):
+        if self.backend == "threads":
+            # the recording cache is shared by all threads of this process
+            return asyncio.wrap_future(executor.submit(self._load_recording, segments))
+
+        if self.cache_bytes <= 0:
+            return asyncio.wrap_future(executor.submit(Abstract_in_h5_csv._read_recording, segments, self.columns, self.rows))
+
+        # worker processes have caches of their own, so cache in this process
+        key = _cache.key(segments) + ((None if self.columns is None else tuple(self.columns), self.rows),)
+        if (recording := _cache.get(key)) is not None:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(recording)
+            return future
+
+        def put(future):
+            if not future.cancelled() and future.exception() is None:
+                _cache.put(key, future.result(), self.cache_bytes)
+
+        future = asyncio.wrap_future(executor.submit(Abstract_in_h5_csv._read_recording, segments, self.columns, self.rows))
+        future.add_done_callback(put)
+        return future
+
+    async def _batches(self, recordings):
+        """Yields segments, data, channels and annotation of each batch along with the percentage sent."""
+        infos = self._recording_infos(recordings)
+        if infos is not None:
+            sizes = [self._selected_samples(info['n_samples']) for info in infos]
+        elif self.max_samples_per_batch:
+            sizes = [self._selected_samples(self._n_samples(segments)) for segments in recordings]
+
+        if self.max_samples_per_batch:
+            n_samples = max(1, sum(sizes))
+            n_sent = 0
+            for segments in recordings:
+                for ts, channels, annot in self._load_blocks(segments, self.max_samples_per_batch):
+                    n_sent += len(ts)
+                    yield segments, ts, channels, annot, round(n_sent / n_samples, 2)
+            return
+
+        # by samples if known from the index, otherwise by files
+        done = np.cumsum(sizes) / max(1, sum(sizes)) if infos is not None else np.arange(1, len(recordings) + 1) / len(recordings)
+        i = -1
+        async for segments, (ts, channels, annot) in self._loaded_recordings(recordings):
+            i += 1
+            yield segments, ts, channels, annot, round(float(done[i]), 2)
 
     async def _async_run(self):
-        files = glob.glob(self.files)
-        n_files = len(files)
+        recordings = self._glob_recordings()
+        n_files = len(recordings)
         self.info(f'Files found: {n_files}, {os.getcwd()}')
 
-        for i, f in enumerate(files):
-            self.info(f'Processing {f}')
+        if self.follow:
+            for i, segments in enumerate(recordings):
+                self.info(f'Processing {segments[0]}')
+                percent = round((i + 1) / n_files, 2)
+                for f in segments:
+                    channels = None
+                    async for ts, dataset in self._follow(f):
+                        if channels is None:
+                            channels = self._overwrite_channels(self._read_channels(f, dataset), ts.shape[1])
+                            yield self.ret(ts=ts, channels=channels, percent=percent)
+                        else:
+                            yield self.ret(ts=ts, percent=percent)
+            return
 
-            ts, channels, annot = self._read_data(f)
+        last_segments = None
+        async for segments, ts, channels, annot, percent in self._batches(recordings):
+            if segments is not last_segments:
+                self.info(f'Processing {segments[0]}')
+                last_segments = segments
 
             channels = self._overwrite_channels(channels, ts.shape[1])
 
-            annot = np.array(annot).reshape(-1, 1)
+            if self.categorical:
+                annot, labels_changed = self._encode_annotation(annot)
+                if labels_changed:
+                    self.ret_accu(list(self.label_codes), port=self.ports_out.annot_labels)
 
-            percent = round((i + 1) / n_files, 2)
+            annot = np.array(annot).reshape(-1, 1)
 
-            yield self.ret(ts=ts, channels=channels, annot=annot, percent=percent)
+            self.ret_accu(ts, port=self.ports_out.ts)
+            self.ret_accu(channels, port=self.ports_out.channels)
+            self.ret_accu(annot, port=self.ports_out.annot)
+            self.ret_accu(percent, port=self.ports_out.percent)
+            yield self.ret_accumulated()
 
             await asyncio.sleep(0)  # so other tasks can run
@@ -1,11 +1,65 @@
 import asyncio
 import time
 import numpy as np
-import glob, random
+import random
 
 from .abstract_in_h5_csv import Abstract_in_h5_csv
 
 
+class _Pacer:
+    """Deadline based scheduler emitting one tick every `interval` seconds.
+
+    Tick deadlines are absolute offsets from the monotonic start time, such
+    that sleep overshoot is compensated on the next tick instead of
+    accumulating. Lateness of each tick against its deadline is tracked as
+    jitter statistic.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start = None
+        self.ticks = 0
+        self.waits = 0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+
+    async def wait(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        self.ticks += 1
+        self.waits += 1
+        deadline = self.start + self.ticks * self.interval
+
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+        lateness = max(0.0, time.monotonic() - deadline)
+        self.lateness_sum += lateness
+        self.lateness_max = max(self.lateness_max, lateness)
+
+    def overdue(self):
+        """Number of ticks whose deadline already passed without them being waited for."""
+        if self.start is None:
+            return 0
+        return max(0, int((time.monotonic() - self.start) / self.interval) - self.ticks)
+
+    def skip(self, n):
+        """Advances the schedule by `n` ticks without waiting for them."""
+        self.ticks += n
+
+    @property
+    def jitter(self):
+        """Mean lateness of waited for ticks against their deadline in seconds."""
+        return self.lateness_sum / self.waits if self.waits > 0 else 0.0
+
+    def reset_jitter(self):
+        """Restarts the jitter statistic, keeping the schedule."""
+        self.waits = 0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+
+
 class In_playback_h5_csv(Abstract_in_h5_csv):
     """Reads and plays back HDF5/.h5 data and corresponding .csv annotation.
 
@@ -18,21 +72,29 @@ class In_playback_h5_csv(Abstract_in_h5_csv):
 
     This node simulates real-time usage via the `sample_rate` meta parameter.
     The time between each `process` invocation depends on both `emit_at_once`
-    and `sample_rate`.
+    and `sample_rate`. Batches are scheduled against absolute deadlines on a
+    monotonic clock, such that the long-run rate matches `sample_rate`; mean
+    and maximum lateness of the batches are logged after each file and when
+    the node is stopped.
 
     Channels sent via the Channel Names port are named by priority:
         - List of names from meta parameter if given.
+        - List of names from the "data" dataset attributes if found.
         - List of names from valid JSON file if found.
         - Otherwise ascending from "0".
 
     If a valid annotation CSV file with the same base name is found, its
     content is sent via the Annotation port. .h5 and .csv files created via
-    the `Out_h5_csv` node automatically follow this format.
+    the `Out_h5_csv` node automatically follow this format. Segmented
+    recordings written with one of its `rotate_*` settings are played back as
+    one continuous recording.
 
     Attributes
     ----------
     files : str
-        glob pattern for files to include. Should end with ".h5" extension.
+        glob pattern for files to include. Should end with ".h5" extension,
+        or ".arrow"/".parquet" for files written with the `file_format`
+        setting of `Out_h5_csv`.
         Common examples are single files ("../data/data.h5") or all files in a
         directory ("../data/*.h5"). In the case of multiple files, a random
         file is selected.
@@ -42,8 +104,71 @@ class In_playback_h5_csv(Abstract_in_h5_csv):
         file selection is re-randomized on each loop.
     sample_rate : int
         Sample rate to simulate in frames per second.
+    speed : float
+        Playback speed relative to `sample_rate`, e.g. 10 plays back ten
+        times faster than real time. If 0 or `None`, playback is unthrottled
+        and batches are sent as fast as they can be read and consumed.
+    catch_up : str, optional
+        Behavior if playback falls more than `max_lag` batches behind
+        schedule, e.g. due to slow downstream nodes. "coalesce" merges the
+        overdue samples into one larger batch, "drop" discards them. A
+        warning is logged when playback first falls behind within a file, the
+        number of coalesced or dropped samples after each file and when the
+        node is stopped.
+        If `None`, every batch is sent. As batches are scheduled against
+        absolute deadlines, overdue batches are then sent back to back
+        without waiting until playback is on schedule again.
+    max_lag : int
+        Number of batches playback may fall behind schedule before `catch_up`
+        applies.
     emit_at_once : int
         Batch size.
+    block_size : int
+        Number of samples read from file at once. Files are read block by
+        block ahead of playback instead of loading them entirely, such that
+        memory usage is independent of the file size. Rounded up to a
+        multiple of `emit_at_once`. Contiguous, uncompressed datasets are
+        mapped from disk instead, such that blocks and batches are read-only
+        views sharing the page cache with other processes.
+    prefetch : int
+        Number of blocks read ahead on a background thread. The next file is
+        then chosen and read while the current one still plays, so playback
+        does not stall at file boundaries. If 0, blocks are read on demand.
+    select_channels : list of str or int, optional
+        Channels to read, by name or index. Names are resolved against the
+        `meta` channel names if given, otherwise against those of each file.
+        Only the selected columns are read from disk and sent, in the given
+        order.
+    select_start : int or float, optional
+        First sample to read from each recording, in `unit`.
+    select_stop : int or float, optional
+        Sample to stop reading each recording at (exclusive), in `unit`.
+        Only the selected rows are read from disk.
+    unit : str
+        Unit of `select_start` and `select_stop`, either "samples" or "seconds". Seconds
+        require the 'sample_rate' meta parameter.
+    shard_index : int
+        Index of the shard to read, from 0 to `shard_count` - 1.
+    shard_count : int
+        Number of shards the recordings matched by `files` are split into,
+        e.g. one per worker of a distributed job. Each recording is read by
+        exactly one shard. Recordings are assigned deterministically and
+        balanced by file size, such that all shards get about the same amount
+        of data. If 1, all recordings are read.
+    categorical : bool
+        Whether to send integer label codes instead of annotation strings via
+        the Annotation port. The label table is sent via the Annotation
+        Labels port whenever new labels are encountered, usually only once.
+    cache_bytes : int
+        Memory budget in bytes of the per process cache of decoded
+        recordings, such that looped recordings are not read again. Only
+        recordings fitting the budget are cached, larger ones are streamed
+        block-wise. If 0, no recordings are cached.
+    index : str, optional
+        Path of an index file, which records sample count, dtype, channels,
+        annotation labels and size of each file. It is built on the first run
+        and only files modified since are read again. The channels of all
+        files are then validated before playback starts.
     compute_on : str
         Multiprocessing/-threading location to run node on. Advanced feature;
         see LiveNodes core docs for details.
@@ -65,12 +190,24 @@ class In_playback_h5_csv(Abstract_in_h5_csv):
     annot : Port_TimeSeries, single channel
         Batch of annotation strings corresponding to data batch. Only sent
         if valid .csv annotation file found. Otherwise empty.
+    annot_labels : Port_ListUnique_Str
+        Label table for the codes sent via the Annotation port, where the
+        code is the index into the list. Only sent in `categorical` mode.
 
     Raises
     ------
+    ValueError
+        If `catch_up` is not one of "coalesce", "drop" or `None`.
     ValueError
         If number of channel names from meta parameter or JSON file does not
         equal actual number of channels.
+    ValueError
+        If `index` is set and the channels of files differ from each other.
+    ValueError
+        If a selected channel is not found, `unit` is unknown or
+        `select_start` or `select_stop` is negative.
+    ValueError
+        If `shard_index` is not within 0 and `shard_count`.
     """
 
     example_init = {
@@ -80,57 +217,192 @@ class In_playback_h5_csv(Abstract_in_h5_csv):
         'emit_at_once': 10,
     }
 
-    def __init__(self, files, meta, loop=True, emit_at_once=10, name="Playback", compute_on="1", **kwargs):
+    def __init__(
+        self,
+        files,
+        meta,
+        loop=True,
+        emit_at_once=10,
+        name="Playback",
+        compute_on="1",
+        block_size=4096,
+        prefetch=4,
+        speed=1.0,
+        catch_up=None,
+        max_lag=10,
+        **kwargs,
+    ):
         super().__init__(name=name, files=files, meta=meta, compute_on=compute_on, **kwargs)
         self.loop = loop
         self.emit_at_once = emit_at_once
+        self.block_size = block_size
+        self.prefetch = prefetch
+        self.speed = speed
+        self.catch_up = catch_up
+        self.max_lag = max_lag
         self.sample_rate = meta.get('sample_rate')
+        self.pacer = None
+        self.coalesced, self.dropped, self.behind = 0, 0, False
+
+        if self.catch_up not in (None, "coalesce", "drop"):
+            raise ValueError(f'Unknown catch_up "{self.catch_up}", must be one of "coalesce", "drop" or None.')
 
     def _settings(self):
         return {
             "emit_at_once": self.emit_at_once,
+            "block_size": self.block_size,
+            "prefetch": self.prefetch,
+            "speed": self.speed,
+            "catch_up": self.catch_up,
+            "max_lag": self.max_lag,
             "files": self.files,
             "loop": self.loop,
             "meta": self.meta,
+            "categorical": self.categorical,
+            "cache_bytes": self.cache_bytes,
+            "index": self.index,
+            "select_channels": self.select_channels,
+            "select_start": self.select_start,
+            "select_stop": self.select_stop,
+            "unit": self.unit,
+            "shard_index": self.shard_index,
+            "shard_count": self.shard_count,
         }
 
-    async def _async_run(self):
-        """
-        Streams the data and calls frame callbacks for each frame.
-        """
-        fs = glob.glob(self.files)
-        sleep_time = 1.0 / (self.sample_rate / self.emit_at_once)
-        last_time = time.time()
-
-        ctr = -1
+    def _playback_blocks(self, fs):
+        """Selects files to play back and reads them block-wise, yielding the file, block index and block."""
+        # block boundaries aligned to batch boundaries
+        block_size = -(-self.block_size // self.emit_at_once) * self.emit_at_once
 
         # TODO: add sigkill handler
         loop = True  # Should run at least once either way
         while loop:
             loop = self.loop
             f = random.choice(fs)
-            ctr += 1
-            self.info(ctr, f)
+            for j, block in enumerate(self._load_blocks(f, block_size)):
+                yield f, j, block
 
-            ts, channels, annot = self._read_data(f)
+    def _log_stats(self):
+        """Logs the playback jitter and catch up statistics since the last call, i.e. of the file played back last."""
+        if self.coalesced > 0 or self.dropped > 0:
+            self.warn(f'Behind schedule: coalesced {self.coalesced} and dropped {self.dropped} samples')
+        self.coalesced, self.dropped, self.behind = 0, 0, False
+        if self.pacer is not None and self.pacer.waits > 0:
+            self.info(f'Playback jitter: mean {self.pacer.jitter * 1000:.3f} ms, max {self.pacer.lateness_max * 1000:.3f} ms over {self.pacer.waits} batches')
+            self.pacer.reset_jitter()
 
-            channels = self._overwrite_channels(channels, ts.shape[1])
+    def _onstop(self):
+        super()._onstop()
+        # looped playback only ends by stopping the node
+        self._log_stats()
 
-            if ctr == 0:
-                self.ret_accu(channels, port=self.ports_out.channels)
+    async def _batches(self, blocks):
+        """Splits played back blocks into batches, yielding file, data, channels and annotation of each batch along with whether it is the first of its file.
 
-            # TODO: for some reason i have no fucking clue about using read_data results in the annotation plot in draw recog to be wrong, although the targs are exactly the same (yes, if checked read_data()[1] == targs)...
-            for i in range(0, len(ts), self.emit_at_once):
-                result_data = np.array(ts[i : i + self.emit_at_once])
-                self.ret_accu(result_data, port=self.ports_out.ts)
+        If playback falls more than `max_lag` batches behind schedule, the
+        overdue batches are merged into the next batch or dropped according
+        to `catch_up`, continuing into the following blocks of the file if the
+        current block ends first.
+        """
+        pieces, need, skip, first = [], 0, 0, False
+        async for f, j, (ts, channels, annot) in blocks:
+            if j == 0:
+                if len(pieces) > 0:
+                    # catch up does not reach into the next file, the merged batch ends with the file instead
+                    yield self._join_batch(batch, pieces)
+                pieces, need, skip, first = [], 0, 0, True
+                # all batches of the previous file are sent at this point
+                self._log_stats()
+
+            if self.categorical and len(annot) > 0:
+                # encoded block-wise, such that the label table usually only grows on the first block
+                annot, _ = self._encode_annotation(annot)
+
+            i = 0
+            while i < len(ts):
+                if skip > 0:
+                    n = min(skip * self.emit_at_once, len(ts) - i)
+                    skip -= -(-n // self.emit_at_once)
+                    self.dropped += n
+                    i += n
+                    continue
+
+                if need == 0:
+                    batch, first, need = (f, first, channels), False, self.emit_at_once
+                    overdue = self.pacer.overdue() if self.pacer is not None and self.catch_up is not None else 0
+                    if overdue > self.max_lag:
+                        self.pacer.skip(overdue)
+                        if not self.behind:
+                            # warned once per file, the number of samples caught up is logged after it
+                            self.warn(f'Fell {overdue} batches behind schedule, catch up: {self.catch_up}')
+                            self.behind = True
+                        self.debug(f'{overdue} batches behind schedule, catch up: {self.catch_up}')
+                        if self.catch_up == "coalesce":
+                            need += overdue * self.emit_at_once
+                        else:
+                            # the batch itself is sent after the dropped ones
+                            batch, first, need, skip = None, batch[1], 0, overdue
+                            continue
+
+                # views into the block, which may itself be mapped from disk
+                n = min(need, len(ts) - i)
+                pieces.append((ts[i : i + n], annot[i : i + n]))
+                need -= n
+                i += n
+                if need == 0:
+                    yield self._join_batch(batch, pieces)
+                    pieces = []
+
+        if len(pieces) > 0:
+            yield self._join_batch(batch, pieces)
+
+    def _join_batch(self, batch, pieces):
+        """Joins the pieces of a batch, which only span several blocks if merged to catch up, counting the merged samples."""
+        f, first, channels = batch
+        if len(pieces) == 1:
+            ts, annot = pieces[0]
+        else:
+            ts = np.concatenate([ts for ts, _ in pieces], axis=0)
+            annot = []
+            if any(len(annot) > 0 for _, annot in pieces):
+                annot = np.concatenate([annot for _, annot in pieces])
+        self.coalesced += max(0, len(ts) - self.emit_at_once)
+        return f, first, ts, channels, annot
+
+    async def _async_run(self):
+        """
+        Streams the data and calls frame callbacks for each frame.
+        """
+        fs = self._glob_recordings()
+        self._recording_infos(fs)
+        self.pacer = pacer = _Pacer(interval=self.emit_at_once / (self.sample_rate * self.speed)) if self.speed else None
+
+        ctr, n_labels = -1, 0
+        self.coalesced, self.dropped, self.behind = 0, 0, False
 
-                if len(annot[i : i + self.emit_at_once]) > 0:
-                    # use reshape -1, as the data can also be shorter than emit_at_once and will be adjusted accordingly
-                    self.ret_accu(np.array(annot[i : i + self.emit_at_once]).reshape(-1, 1), port=self.ports_out.annot)
+        async for f, first, ts, channels, annot in self._batches(self._prefetched(self._playback_blocks(fs), self.prefetch)):
+            if first:
+                ctr += 1
+                self.info(ctr, f)
+
+                channels = self._overwrite_channels(channels, ts.shape[1])
+
+                if ctr == 0:
+                    self.ret_accu(channels, port=self.ports_out.channels)
+
+            if len(self.label_codes) > n_labels:
+                n_labels = len(self.label_codes)
+                self.ret_accu(list(self.label_codes), port=self.ports_out.annot_labels)
+
+            # TODO: for some reason i have no fucking clue about using read_data results in the annotation plot in draw recog to be wrong, although the targs are exactly the same (yes, if checked read_data()[1] == targs)...
+            self.ret_accu(ts, port=self.ports_out.ts)
+            if len(annot) > 0:
+                # use reshape -1, as the data can also be shorter than emit_at_once and will be adjusted accordingly
+                self.ret_accu(np.array(annot).reshape(-1, 1), port=self.ports_out.annot)
 
-                while time.time() < last_time + sleep_time:
-                    await asyncio.sleep(0.0001)
+            if pacer is not None:
+                await pacer.wait()
 
-                last_time = time.time()
+            yield self.ret_accumulated()
 
-                yield self.ret_accumulated()
+        self._log_stats()
@@ -0,0 +1,288 @@
+import numpy as np
+import pyarrow as pa
+
+from livenodes import Ports_collection
+
+from .abstract_in_h5_csv import Abstract_in_h5_csv
+from ln_ports import Port_3D_Any, Port_3D_Number, Port_ListUnique_Str
+
+
+class Ports_out(Ports_collection):
+    ts: Port_3D_Number = Port_3D_Number("Windows")
+    channels: Port_ListUnique_Str = Port_ListUnique_Str("Channel Names")
+    annot: Port_3D_Any = Port_3D_Any("Annotation")
+    annot_labels: Port_ListUnique_Str = Port_ListUnique_Str("Annotation Labels")
+
+
+class In_window_h5_csv(Abstract_in_h5_csv):
+    """Samples random fixed-length windows from HDF5/.h5 data and corresponding .csv annotation.
+
+    Each batch contains `batch_size` windows of `window` samples, drawn from
+    all recordings matched by `files`. Windows are sampled uniformly over all
+    window positions of all recordings, such that longer recordings are
+    sampled more often, or stratified by annotation label, such that each
+    label is sampled equally often regardless of its share of the data. Only
+    the samples of each window are read from disk. Intended as data source of
+    training pipelines, for sending whole files use the `In_h5_csv` node
+    instead.
+
+    Channels sent via the Channel Names port are named by priority:
+        - List of names from meta parameter if given.
+        - List of names from the "data" dataset attributes if found.
+        - List of names from valid JSON file if found.
+        - Otherwise ascending from "0".
+
+    If a valid annotation CSV file with the same base name is found, the
+    annotation of each window is sent via the Annotation port. .h5 and .csv
+    files created via the `Out_h5_csv` node automatically follow this format.
+
+    Attributes
+    ----------
+    files : str
+        glob pattern for files to include. Should end with ".h5" extension,
+        or ".arrow"/".parquet" for files written with the `file_format`
+        setting of `Out_h5_csv`.
+    window : int
+        Number of samples per window.
+    batch_size : int
+        Number of windows per batch.
+    n_batches : int, optional
+        Number of batches to send. If `None`, batches are sent until the node
+        is stopped.
+    stratify : bool
+        Whether to sample windows stratified by annotation label. Each window
+        then lies within a single annotation run, first a label is drawn
+        uniformly and then one of its window positions. Samples not covered
+        by any annotation run are not sampled.
+    seed : int, optional
+        Seed of the random number generator, such that the same windows are
+        sampled on each run. If `None`, windows differ between runs.
+    prefetch : int
+        Number of batches read ahead on a background thread. If 0, batches
+        are read on demand.
+    select_channels : list of str or int, optional
+        Channels to read, by name or index. Names are resolved against the
+        `meta` channel names if given, otherwise against those of each file.
+    select_start : int or float, optional
+        First sample of each recording to sample windows from, in `unit`.
+    select_stop : int or float, optional
+        Sample of each recording to stop sampling windows at (exclusive), in
+        `unit`.
+    unit : str
+        Unit of `select_start` and `select_stop`, either "samples" or
+        "seconds". Seconds require the 'sample_rate' meta parameter.
+    shard_index : int
+        Index of the shard to read, from 0 to `shard_count` - 1.
+    shard_count : int
+        Number of shards the recordings matched by `files` are split into,
+        e.g. one per worker of a distributed job. Each recording is read by
+        exactly one shard. Recordings are assigned deterministically and
+        balanced by file size, such that all shards get about the same amount
+        of data. If 1, all recordings are read.
+    categorical : bool
+        Whether to send integer label codes instead of annotation strings via
+        the Annotation port. The label table is sent via the Annotation
+        Labels port whenever new labels are encountered.
+    index : str, optional
+        Path of an index file, which records sample count, dtype, channels,
+        annotation labels and size of each file. It is built on the first run
+        and only files modified since are read again. The channels of all
+        files are then validated before sampling starts.
+    meta : dict
+        Dict of meta parameters.
+
+        * 'channel_names' : list of unique str
+            List of channel names for `channels` port.
+
+    Ports Out
+    ---------
+    ts : Port_3D_Number
+        Batch of windows of shape (batch_size, window, channels).
+    channels : Port_ListUnique_Str
+        List of channel names. Can be loaded from JSON file and/or overwritten
+        using the `meta` attribute.
+    annot : Port_3D_Any
+        Annotation of the windows of shape (batch_size, window, 1). Only sent
+        if valid .csv annotation file found.
+    annot_labels : Port_ListUnique_Str
+        Label table for the codes sent via the Annotation port, where the
+        code is the index into the list. Only sent in `categorical` mode.
+
+    Raises
+    ------
+    ValueError
+        If `window` or `batch_size` is smaller than 1.
+    ValueError
+        If `shard_index` is not within 0 and `shard_count`.
+    ValueError
+        If no recording or, with `stratify`, no annotation run is at least
+        `window` samples long.
+    """
+
+    ports_out = Ports_out()
+
+    example_init = {'name': 'Windows', 'files': 'data/*.h5', 'meta': {'channels': [""]}, 'window': 100, 'batch_size': 32}
+
+    def __init__(self, name="Windows", files='data', meta={}, window=100, batch_size=32, n_batches=None, stratify=False, seed=None, prefetch=4, **kwargs):
+        super().__init__(name, files, meta, **kwargs)
+        self.window = window
+        self.batch_size = batch_size
+        self.n_batches = n_batches
+        self.stratify = stratify
+        self.seed = seed
+        self.prefetch = prefetch
+
+        if self.window < 1 or self.batch_size < 1:
+            raise ValueError(f"Window {self.window} and batch size {self.batch_size} must be at least 1.")
+
+    def _settings(self):
+        return {
+            "files": self.files,
+            "meta": self.meta,
+            "window": self.window,
+            "batch_size": self.batch_size,
+            "n_batches": self.n_batches,
+            "stratify": self.stratify,
+            "seed": self.seed,
+            "prefetch": self.prefetch,
+            "categorical": self.categorical,
+            "cache_bytes": self.cache_bytes,
+            "index": self.index,
+            "select_channels": self.select_channels,
+            "select_start": self.select_start,
+            "select_stop": self.select_stop,
+            "unit": self.unit,
+            "shard_index": self.shard_index,
+            "shard_count": self.shard_count,
+        }
+
+    def _recording_layout(self, segments):
+        """Reads the selected samples and annotation runs of each segment of a recording once.
+
+        Returns the first selected row of each segment, the offsets of the
+        segments within the selected rows of the recording and its annotation
+        runs as start, end and label arrays relative to those rows, or None
+        instead of runs if no segment is annotated.
+        """
+        firsts, offsets, starts, ends, labels = [], [0], [], [], []
+        for f, rows in zip(segments, self._segment_rows(segments, self.rows)):
+            n_samples = 0
+            try:
+                with self._open_data(f, None, rows) as (dataset, _, runs):
+                    n_samples = len(dataset)
+                    if runs is not None:
+                        # runs of segments end at the segment boundary, with `stratify` windows thus never span segments
+                        starts.append(np.clip(np.asarray(runs[0], dtype=np.int64), 0, n_samples) + offsets[-1])
+                        ends.append(np.clip(np.asarray(runs[1], dtype=np.int64), 0, n_samples) + offsets[-1])
+                        labels.append(np.asarray(runs[2]).astype(str))
+            except (OSError, TypeError, pa.ArrowException):
+                print('Could not open file, skipping', f)
+            firsts.append(0 if rows is None else rows[0] or 0)
+            offsets.append(offsets[-1] + n_samples)
+
+        runs = None
+        if len(starts) > 0:
+            runs = np.concatenate(starts), np.concatenate(ends), np.concatenate(labels)
+        return firsts, np.asarray(offsets), runs
+
+    def _window_candidates(self, layouts):
+        """Lists the ranges windows may start in, as recording index, first start, number of starts and sampling probability arrays.
+
+        Each range is a whole recording, or with `stratify` an annotation
+        run, which is sampled proportionally to its number of window starts.
+        With `stratify`, the probabilities are normalized per label instead,
+        such that all labels are sampled equally often.
+        """
+        if not self.stratify:
+            recs = np.arange(len(layouts))
+            firsts = np.zeros(len(layouts), dtype=np.int64)
+            positions = np.maximum(np.array([offsets[-1] for _, offsets, _ in layouts], dtype=np.int64) - self.window + 1, 0)
+            if positions.sum() == 0:
+                raise ValueError(f"No recording of {self.files} is at least {self.window} samples long.")
+            return recs, firsts, positions, positions / positions.sum()
+
+        recs, firsts, positions, labels = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=str)]
+        for i, (_, _, runs) in enumerate(layouts):
+            if runs is None:
+                continue
+            starts, ends, run_labels = runs
+            fits = ends - starts >= self.window
+            recs.append(np.full(fits.sum(), i))
+            firsts.append(starts[fits])
+            positions.append(ends[fits] - starts[fits] - self.window + 1)
+            labels.append(run_labels[fits])
+        recs, firsts, positions, labels = map(np.concatenate, (recs, firsts, positions, labels))
+        if len(positions) == 0:
+            raise ValueError(f"No annotation run of {self.files} is at least {self.window} samples long.")
+
+        names, label_idx = np.unique(labels, return_inverse=True)
+        label_positions = np.bincount(label_idx, weights=positions)
+        return recs, firsts, positions, positions / label_positions[label_idx] / len(names)
+
+    def _read_window(self, segments, layout, start):
+        """Reads the window starting at `start` of the selected rows of a recording, returning data, channels and annotation.
+
+        Only the samples of the window are read, its annotation is cut from
+        the annotation runs of the recording.
+        """
+        firsts, offsets, runs = layout
+        stop = start + self.window
+        parts, channels = [], []
+        # windows may span segments, unless sampled with `stratify`
+        for k in range(np.searchsorted(offsets, start, side='right') - 1, np.searchsorted(offsets, stop, side='left')):
+            rows = (firsts[k] + max(start, offsets[k]) - offsets[k], firsts[k] + min(stop, offsets[k + 1]) - offsets[k])
+            with self._open_data(segments[k], self.columns, rows, annotation=False) as (dataset, channels, _):
+                parts.append(dataset[:])
+
+        annot = []
+        if runs is not None:
+            # windows of recordings without annotation file are treated as not annotated
+            overlaps = (runs[1] > start) & (runs[0] < stop)
+            annot = self._expand_annotation(runs[0][overlaps] - start, runs[1][overlaps] - start, runs[2][overlaps], self.window)
+        return np.concatenate(parts, axis=0), channels, annot
+
+    def _batches(self, recordings, layouts, candidates):
+        """Samples and reads batches of windows, yielding data, channels and annotation of each batch."""
+        recs, firsts, positions, p = candidates
+        rng = np.random.default_rng(self.seed)
+
+        n = 0
+        while self.n_batches is None or n < self.n_batches:
+            picked = rng.choice(len(p), size=self.batch_size, p=p)
+            starts = firsts[picked] + rng.integers(0, positions[picked])
+
+            windows = [self._read_window(recordings[i], layouts[i], int(start)) for i, start in zip(recs[picked], starts)]
+            ts = np.stack([data for data, _, _ in windows])
+            annot = []
+            if any(len(a) > 0 for _, _, a in windows):
+                annot = np.stack([a if len(a) > 0 else np.full(self.window, "") for _, _, a in windows])[:, :, np.newaxis]
+            yield ts, windows[0][1], annot
+            n += 1
+
+    async def _async_run(self):
+        """
+        Samples windows and sends them batch by batch.
+        """
+        recordings = self._glob_recordings()
+        # validates the channels of all recordings if an `index` file is set
+        self._recording_infos(recordings)
+        # lengths and annotation runs are read once, windows then only read their samples
+        layouts = [self._recording_layout(segments) for segments in recordings]
+        candidates = self._window_candidates(layouts)
+
+        ctr = 0
+        async for ts, channels, annot in self._prefetched(self._batches(recordings, layouts, candidates), self.prefetch):
+            if ctr == 0:
+                self.ret_accu(self._overwrite_channels(channels, ts.shape[2]), port=self.ports_out.channels)
+            ctr += 1
+
+            self.ret_accu(ts, port=self.ports_out.ts)
+            if len(annot) > 0:
+                if self.categorical:
+                    codes, labels_changed = self._encode_annotation(annot.reshape(-1))
+                    annot = codes.reshape(annot.shape)
+                    if labels_changed:
+                        self.ret_accu(list(self.label_codes), port=self.ports_out.annot_labels)
+                self.ret_accu(annot, port=self.ports_out.annot)
+
+            yield self.ret_accumulated()
@@ -3,7 +3,11 @@ import datetime
 import h5py
 import json
 import os
+import queue
+import threading
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from livenodes.node import Node
 
@@ -11,11 +15,136 @@ from livenodes.node import Node
 from ln_ports import Port_ListUnique_Str, Port_Timeseries, Ports_empty
 from livenodes import Ports_collection
 
+# Default staging buffer size in bytes after which the buffer is written to file.
+_FLUSH_BYTES = 1024 * 1024
+# Upper bound for automatically chosen chunk sizes, see h5py docs on chunking.
+_MAX_CHUNK_BYTES = 1024 * 1024
+# File extension per file format.
+_EXTENSIONS = {"h5": ".h5", "arrow": ".arrow", "parquet": ".parquet"}
+
 
 class Ports_in(Ports_collection):
     ts: Port_Timeseries = Port_Timeseries("TimeSeries")
     channels: Port_ListUnique_Str = Port_ListUnique_Str("Channel Names")
     annot: Port_Timeseries = Port_Timeseries("Annotation")
+    annot_labels: Port_ListUnique_Str = Port_ListUnique_Str("Annotation Labels")
+
+
+class _Segment:
+    """HDF5 file and "data" dataset of a single recording segment.
+
+    Written to either directly by the node or by its writer thread.
+    """
+
+    def __init__(self, filename, swmr=False):
+        self.swmr = swmr
+        self.file = h5py.File(filename, 'w', libver='latest') if swmr else h5py.File(filename, 'w')
+        self.dataset = None
+        self.n_written = 0
+        self.annot = None
+        self.annot_labels = None
+        # label table of the "annot_labels" dataset, maps annotation strings to codes in order of appearance
+        self.labels = {}
+
+    def write(self, buffer, n, growth_factor, annot=None):
+        # data is written first, such that annotation never refers to unwritten samples
+        end = self.n_written + n
+        if end > self.dataset.shape[0]:
+            # grow geometrically to keep the number of resizes logarithmic in the recording length
+            # SWMR readers rely on the dataset shape, so it has to match the written samples exactly
+            size = end if self.swmr else max(end, int(self.dataset.shape[0] * growth_factor))
+            self.dataset.resize(size, axis=0)
+        self.dataset[self.n_written : end] = buffer[:n]
+        self.n_written = end
+        if self.swmr:
+            # make the appended samples visible to readers
+            self.dataset.flush()
+        if annot is not None:
+            self.write_annotation(annot)
+
+    def create_annotation(self):
+        # created up front, as no new objects may be added once in SWMR mode
+        self.annot = self.file.create_dataset("annot", (0, 3), maxshape=(None, 3), dtype=np.int64, chunks=True)
+        self.annot.attrs['columns'] = ['start', 'end', 'label']
+        self.annot_labels = self.file.create_dataset("annot_labels", (0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+
+    def write_annotation(self, runs):
+        """Appends finished annotation runs of start, end and annotation string."""
+        if len(runs) == 0:
+            return
+        starts, ends, labels = zip(*runs)
+        n_labels = len(self.labels)
+        for label in labels:
+            self.labels.setdefault(label, len(self.labels))
+        if len(self.labels) > n_labels:
+            self.annot_labels.resize(len(self.labels), axis=0)
+            self.annot_labels[n_labels:] = np.array(list(self.labels)[n_labels:], dtype=object)
+
+        n_runs = len(self.annot)
+        self.annot.resize(n_runs + len(runs), axis=0)
+        self.annot[n_runs:] = np.stack([starts, ends, [self.labels[label] for label in labels]], axis=1)
+        if self.swmr:
+            self.annot_labels.flush()
+            self.annot.flush()
+
+    def close(self):
+        if self.dataset is not None:
+            # remove the space reserved by geometric growth
+            self.dataset.resize(self.n_written, axis=0)
+        self.file.close()
+
+
+class _Table_segment:
+    """Arrow IPC or Parquet file of a single recording segment.
+
+    Each channel is stored as a column and the annotation, if any, as a
+    dictionary-encoded "annot" column. Buffers are written as record batches,
+    either directly by the node or by its writer thread.
+    """
+
+    def __init__(self, filename, file_format):
+        self.filename = filename
+        self.file_format = file_format
+        # schema of the file, None until created
+        self.dataset = None
+        self.writer = None
+        self.n_written = 0
+        self.annot = None
+        self.labels = {}
+
+    def create_schema(self, channels, dtype, metadata, annotated):
+        fields = [pa.field(str(c), pa.from_numpy_dtype(dtype)) for c in channels]
+        if annotated:
+            fields.append(pa.field("annot", pa.dictionary(pa.int32(), pa.string())))
+        self.annot = annotated
+        self.dataset = pa.schema(fields, metadata={key: json.dumps(val) for key, val in metadata.items()})
+
+    def _open(self):
+        if self.file_format == "arrow":
+            # the label table only grows, thus later record batches extend the dictionary of earlier ones
+            self.writer = pa.ipc.new_file(self.filename, self.dataset, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+        else:
+            self.writer = pq.ParquetWriter(self.filename, self.dataset)
+
+    def write(self, buffer, n, growth_factor, annot=None):
+        if self.writer is None:
+            self._open()
+        columns = [pa.array(buffer[:n, i]) for i in range(buffer.shape[1])]
+        if self.annot:
+            labels, inverse = np.unique(np.asarray(annot, dtype=str), return_inverse=True)
+            for label in labels:
+                self.labels.setdefault(str(label), len(self.labels))
+            codes = np.array([self.labels[str(label)] for label in labels], dtype=np.int32)[inverse.reshape(-1)]
+            columns.append(pa.DictionaryArray.from_arrays(codes, pa.array(list(self.labels), type=pa.string())))
+        self.writer.write_batch(pa.record_batch(columns, schema=self.dataset))
+        self.n_written += n
+
+    def close(self):
+        if self.dataset is not None:
+            if self.writer is None:
+                # recording without samples, still write the schema
+                self._open()
+            self.writer.close()
 
 
 class Out_h5_csv(Node):
@@ -23,20 +152,107 @@ class Out_h5_csv(Node):
 
     Once processing has finished, data is written to a HDF5/.h5 file with the
     current timestamp string as base name. More specifically, a dataset named
-    "data" is created with data samples in rows and channels in columns.
+    "data" is created with data samples in rows and channels in columns. The
+    channel names, dtype and entries of the `meta` attribute are stored as
+    attributes of that dataset. For compatibility, they can also be written to
+    a .json file with the same base name.
 
     If the Annotation port is connected, the annotation will also be saved to a
     .csv file with the same base name. Each line contains a triple of the start
     sample number, the end sample number (exclusive), and the respective
     annotation string.
 
+    Alternatively, with the `annot_in_h5` setting, the annotation is stored in
+    the HDF5/.h5 file itself, such that each recording is a single file. The
+    "annot" dataset then contains one row of start sample, end sample
+    (exclusive) and label code per annotation run, and the "annot_labels"
+    dataset maps label codes to annotation strings.
+
+    For long-running recordings, the output can be split into segments via
+    the `rotate_*` settings. Each segment is a regular .h5/.csv/.json triplet
+    named "<timestamp>.partXXXX". Annotation runs crossing a segment boundary
+    are split at the boundary. A "<timestamp>.manifest.json" file lists the
+    segments in order and is updated whenever a new segment is started.
+
+    With the `file_format` setting, data is written to Apache Arrow IPC
+    (.arrow) or Parquet (.parquet) files instead, with one column per channel
+    and the annotation as dictionary-encoded "annot" column. The dtype and
+    entries of the `meta` attribute are stored as JSON encoded schema
+    metadata. Data is written as one record batch per flush.
+
     Files created using this node are automatically compatible with the
-    `In_h5_csv` and `In_playback_h5_csv` nodes.
+    `In_h5_csv` and `In_playback_h5_csv` nodes, which read segmented
+    recordings back as one continuous recording.
 
     Attributes
     ----------
     folder : str
         folder to save data files to.
+    meta : dict
+        Dict of additional meta parameters stored as dataset attributes, e.g.
+        'sample_rate'. Values must be numbers, strings or lists thereof.
+    write_json : bool
+        Whether to also write channel names and meta parameters to a .json
+        file as done by previous versions.
+    file_format : str
+        Either "h5", "arrow" for Arrow IPC files, or "parquet". The `chunk_size`,
+        compression, `growth_factor`, `swmr` and `annot_in_h5` settings only
+        apply to "h5".
+    annot_in_h5 : bool
+        Whether to store the annotation in the HDF5/.h5 file instead of a .csv
+        file. Finished annotation runs are appended along with each flush of
+        the data, such that memory usage does not grow with the recording.
+    chunk_size : int, optional
+        Number of samples per HDF5 chunk. If not set, the chunk size equals
+        the number of samples written per flush, capped at 1 MiB per chunk.
+    compression : str, optional
+        HDF5 compression filter, either "gzip" or "lzf". No compression if not
+        set.
+    compression_level : int
+        Compression level from 0 to 9. Only used for "gzip" compression.
+    shuffle : bool
+        Whether to apply the HDF5 byte shuffle filter before compression.
+        Usually improves the compression ratio of numeric sensor data.
+    flush_samples : int, optional
+        Maximum number of samples to buffer before writing to file.
+    flush_bytes : int, optional
+        Maximum number of bytes to buffer before writing to file. Together
+        with `flush_samples`, this sets the capacity of the preallocated
+        staging buffer that batches are copied into. Defaults to 1 MiB.
+    flush_seconds : float, optional
+        Maximum time in seconds that samples are buffered before writing to
+        file. Checked whenever a batch is received.
+    growth_factor : float
+        Factor by which the on-disk dataset grows once it is full. The
+        dataset is trimmed to the actual number of samples on stop.
+    async_write : bool
+        Whether to write data to file on a dedicated writer thread. `process`
+        then only hands full buffers over to the writer and continues on a
+        spare buffer, such that it never blocks on HDF5 I/O.
+    queue_size : int
+        Number of spare staging buffers, i.e. the maximum number of full
+        buffers waiting for the writer thread. Only used if `async_write` is
+        set.
+        Must be at least 1.
+    backpressure : str
+        Behavior if the writer queue is full. "block" waits until the writer
+        catches up, "drop" discards the buffer along with its annotation and
+        logs a warning. Later annotation is shifted accordingly, such that it
+        stays aligned with the written samples. The last buffer of a segment
+        is never dropped. Only used if `async_write` is set.
+    swmr : bool
+        Whether to write in HDF5 single-writer/multiple-reader mode, such that
+        the file can be read while it is being written, e.g. with the
+        `follow` setting of `In_h5_csv`. Samples become visible to readers
+        with each flush, so consider setting `flush_seconds` for low latency.
+        Disables geometric dataset growth.
+    rotate_samples : int, optional
+        Start a new segment after this many samples.
+    rotate_bytes : int, optional
+        Start a new segment after this many bytes of (uncompressed) data.
+    rotate_seconds : float, optional
+        Start a new segment after this many seconds. Checked whenever a batch
+        is received.
     compute_on : str
         Multiprocessing/-threading location to run node on. Advanced feature;
         see LiveNodes core docs for details.
@@ -50,6 +266,12 @@ class Out_h5_csv(Node):
     annot : Port_List_Str, optional
         List of annotation strings corresponding to data batch to be saved to
         .csv file, with one string per data sample. Ignored if not connected.
+        May also contain integer label codes if the Annotation Labels port is
+        connected.
+    annot_labels : Port_ListUnique_Str, optional
+        Label table for integer label codes received via the Annotation port,
+        where the code is the index into the list, e.g. from nodes in
+        `categorical` mode. Only required once before the first codes.
     """
 
     ports_in = Ports_in()
@@ -60,11 +282,66 @@ class Out_h5_csv(Node):
 
     example_init = {'name': 'Save', 'folder': './data/'}
 
-    def __init__(self, folder, name="Save", compute_on="", **kwargs):
+    def __init__(
+        self,
+        folder,
+        name="Save",
+        compute_on="",
+        meta={},
+        write_json=False,
+        file_format="h5",
+        annot_in_h5=False,
+        chunk_size=None,
+        compression=None,
+        compression_level=4,
+        shuffle=False,
+        flush_samples=None,
+        flush_bytes=_FLUSH_BYTES,
+        flush_seconds=None,
+        growth_factor=2.0,
+        async_write=False,
+        queue_size=4,
+        backpressure="block",
+        rotate_samples=None,
+        rotate_bytes=None,
+        rotate_seconds=None,
+        swmr=False,
+        **kwargs,
+    ):
         # NOTE: Previous default compute_on="1:1" often caused file write failures, investigate before changing back.
         super().__init__(name, compute_on=compute_on, **kwargs)
 
         self.folder = folder
+        self.meta = meta
+        self.write_json = write_json
+        self.file_format = file_format
+        self.annot_in_h5 = annot_in_h5
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.shuffle = shuffle
+        self.flush_samples = flush_samples
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.growth_factor = growth_factor
+        self.async_write = async_write
+        self.queue_size = queue_size
+        self.backpressure = backpressure
+        self.rotate_samples = rotate_samples
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.swmr = swmr
+
+        if self.file_format not in _EXTENSIONS:
+            raise ValueError(f'Unknown file_format "{self.file_format}", must be one of "h5", "arrow" or "parquet".')
+        if self.swmr and self.file_format != "h5":
+            raise ValueError('SWMR mode is only supported for file_format "h5".')
+        if self.compression not in (None, "gzip", "lzf"):
+            raise ValueError(f'Unknown compression "{self.compression}", must be one of "gzip", "lzf" or None.')
+        if self.backpressure not in ("block", "drop"):
+            raise ValueError(f'Unknown backpressure "{self.backpressure}", must be one of "block" or "drop".')
+        if self.queue_size < 1:
+            raise ValueError(f"Queue size {self.queue_size} must be at least 1.")
 
         if not os.path.exists(self.folder):
             os.makedirs(self.folder)
@@ -74,95 +351,426 @@ class Out_h5_csv(Node):
         self.outputFilename = f"{self.folder}{datetime.datetime.fromtimestamp(time.time())}"
         print("Saving to:", self.outputFilename)
 
-        self.outputFile = None
-        self.outputDataset = None
+        self.segment = None
+        self.segmentFilename = self.outputFilename
+        self.segmentFiles = []
+        self.segment_samples = 0
+        self.segment_time = None
 
         self.outputFileAnnotation = None
+        # closed annotation runs whose samples are not yet flushed, in received samples of the segment
+        self.annotRuns = None
+        # last run mapped to written samples, kept open as it may continue in the next flush
+        self.annotOpen = None
+        self.segment_flushed = 0
+        self.segment_dropped = 0
+        # annotation of the samples not yet written, only used by table formats
+        self.annotRows = None
+        self.annot_labels = None
         self.last_annotation = None
 
         self.channels = None
 
         self.running = False
 
-        self.buffer = []
+        # preallocated staging buffer, only the first buffer_len samples are valid
+        self.buffer = None
+        self.buffer_len = 0
+        self.buffer_time = None
+
+        self.spareBuffers = None
+        self.writeQueue = None
+        self.writer = None
+        self.writerError = None
+        self.dropped_samples = 0
 
     def _settings(self):
-        return {"folder": self.folder}
+        return {
+            "folder": self.folder,
+            "meta": self.meta,
+            "write_json": self.write_json,
+            "file_format": self.file_format,
+            "annot_in_h5": self.annot_in_h5,
+            "chunk_size": self.chunk_size,
+            "compression": self.compression,
+            "compression_level": self.compression_level,
+            "shuffle": self.shuffle,
+            "flush_samples": self.flush_samples,
+            "flush_bytes": self.flush_bytes,
+            "flush_seconds": self.flush_seconds,
+            "growth_factor": self.growth_factor,
+            "async_write": self.async_write,
+            "queue_size": self.queue_size,
+            "backpressure": self.backpressure,
+            "rotate_samples": self.rotate_samples,
+            "rotate_bytes": self.rotate_bytes,
+            "rotate_seconds": self.rotate_seconds,
+            "swmr": self.swmr,
+        }
 
     def _onstart(self):
         if not self.running:
             self.running = True
-            self.outputFile = h5py.File(self.outputFilename + '.h5', 'w')
-            if self._is_input_connected(self.ports_in.annot):
-                self.outputFileAnnotation = open(f"{self.outputFilename}.csv", "w")
-                self.outputFileAnnotation.write("start,end,act\n")
+            self._open_segment()
+            if self.async_write:
+                self.writeQueue = queue.Queue()
+                self.writer = threading.Thread(target=self._write_worker, name=f"{self.name} writer", daemon=True)
+                self.writer.start()
             self.info('Created Files')
 
     def _onstop(self):
         if self.running:
             self.running = False
-            if self._is_input_connected(self.ports_in.annot) and self.last_annotation is not None:
-                self.outputFileAnnotation.write(f"{self.last_annotation[1]},{self.last_annotation[2]},{self.last_annotation[0]}")
-                self.outputFileAnnotation.close()
-
-            self._append_buffer_to_file()
-            self.outputFile.close()
+            self._close_segment()
+            if self.writer is not None:
+                self._stop_writer()
             self.info('Stopped writing out and closed files')
 
-    def _should_process(self, ts=None, channels=None, annot=None):
+    def _rotating(self):
+        return self.rotate_samples is not None or self.rotate_bytes is not None or self.rotate_seconds is not None
+
+    def _open_segment(self):
+        if self._rotating():
+            self.segmentFilename = f"{self.outputFilename}.part{len(self.segmentFiles):04d}"
+            self.segmentFiles.append(os.path.basename(self.segmentFilename) + _EXTENSIONS[self.file_format])
+            self._write_manifest()
+
+        if self.file_format == "h5":
+            self.segment = _Segment(self.segmentFilename + '.h5', swmr=self.swmr)
+        else:
+            self.segment = _Table_segment(self.segmentFilename + _EXTENSIONS[self.file_format], self.file_format)
+        self.segment_samples = 0
+        self.segment_flushed = 0
+        self.segment_dropped = 0
+        self.segment_time = time.monotonic()
+
+        if self._is_input_connected(self.ports_in.annot):
+            if self.file_format != "h5":
+                # rows already received, but not yet written, are kept across segments
+                self.annotRows = [] if self.annotRows is None else self.annotRows
+                return
+            self.annotRuns = []
+            if not self.annot_in_h5:
+                self.outputFileAnnotation = open(f"{self.segmentFilename}.csv", "w")
+                self.outputFileAnnotation.write("start,end,act\n")
+
+    def _close_segment(self):
+        # the last buffer of a segment is never dropped
+        self._append_buffer_to_file(block=True)
+        runs = self._close_annotation()
+        if self.writer is not None:
+            self.writeQueue.put((self.segment, None, 0, runs))
+            return
+        if runs is not None:
+            self.segment.write_annotation(runs)
+        self.segment.close()
+
+    def _close_annotation(self):
+        if self.annotRuns is None:
+            return None
+
+        # all samples are flushed, thus the open run is finished
+        runs = self._write_runs([] if self.annotOpen is None else [self.annotOpen])
+        self.annotOpen = None
+        self.annotRuns = None
+
+        if self.outputFileAnnotation is not None:
+            self.outputFileAnnotation.close()
+            self.outputFileAnnotation = None
+        return runs
+
+    def _rotate(self):
+        # split the current annotation run at the segment boundary, it is continued in the next segment
+        self._close_segment()
+        self._open_segment()
+        self._create_dataset(self.buffer[:0])
+        if self.last_annotation is not None:
+            self.last_annotation = (self.last_annotation[0], 0, 0)
+        self.info(f'Started segment {self.segmentFilename}')
+
+    def _rotate_limit(self):
+        # samples per segment, None if only rotating by time
+        limits = []
+        if self.rotate_samples is not None:
+            limits.append(self.rotate_samples)
+        if self.rotate_bytes is not None:
+            limits.append(self.rotate_bytes // max(1, len(self.channels) * self.buffer.dtype.itemsize))
+        return max(1, int(min(limits))) if limits else None
+
+    def _write_manifest(self):
+        with open(f"{self.outputFilename}.manifest.json", 'w') as f:
+            json.dump({'segments': self.segmentFiles}, f, indent=2)
+
+    def _should_process(self, ts=None, channels=None, annot=None, annot_labels=None):
         return (
             ts is not None
             and (self.channels is not None or channels is not None)
             and (annot is not None or not self._is_input_connected(self.ports_in.annot))
+            and (self.annot_labels is not None or annot_labels is not None or not self._is_input_connected(self.ports_in.annot_labels))
         )
 
-    def process(self, ts, channels=None, annot=None, **kwargs):
+    def process(self, ts, channels=None, annot=None, annot_labels=None, **kwargs):
+        ts = np.asarray(ts)
 
-        if channels is not None:
+        if annot_labels is not None:
+            self.annot_labels = list(annot_labels)
+
+        if channels is not None and (self.channels is None or list(channels) != list(self.channels)):
             self.channels = channels
 
-            if self.outputDataset is None:
+            if self.segment.dataset is None:
+                self._create_dataset(ts)
+            else:
+                self._write_meta()
 
-                self.outputDataset = self.outputFile.create_dataset(
-                    "data", (0, len(self.channels)), maxshape=(None, len(self.channels)), dtype=np.array(ts).dtype
-                )
+        if self.rotate_seconds is not None and self.segment_samples > 0 and time.monotonic() - self.segment_time >= self.rotate_seconds:
+            self._rotate()
 
-        if channels is not None:
-            self._write_meta({'channels': channels})
+        # split batch at segment boundaries, such that data and annotation of each segment line up
+        limit = self._rotate_limit()
+        start = 0
+        while start < len(ts):
+            if limit is not None and self.segment_samples >= limit:
+                self._rotate()
+            n = len(ts) - start if limit is None else min(len(ts) - start, limit - self.segment_samples)
 
-        if annot is not None:
-            self.receive_annotation(annot)
+            if annot is not None:
+                self.receive_annotation(annot[start : start + n])
+            self._append_to_buffer(ts[start : start + n])
 
-        self.buffer.append(ts)
-        if len(self.buffer) > 100:
+            self.segment_samples += n
+            start += n
+
+        if self.flush_seconds is not None and self.buffer_len > 0 and time.monotonic() - self.buffer_time >= self.flush_seconds:
             self._append_buffer_to_file()
 
-    def _append_buffer_to_file(self):
-        if len(self.buffer) >= 1:
-            d = np.concatenate(self.buffer, axis=0)  # concat buffer and write to file
-            self.buffer = []
-            self.outputDataset.resize(self.outputDataset.shape[0] + len(d), axis=0)
-            self.outputDataset[-len(d) :] = d
+    def _append_to_buffer(self, ts):
+        # copy batch into the staging buffer, batches larger than the remaining capacity are split across flushes
+        start = 0
+        while start < len(ts):
+            if self.buffer_len == 0:
+                self.buffer_time = time.monotonic()
+            n = min(len(ts) - start, len(self.buffer) - self.buffer_len)
+            self.buffer[self.buffer_len : self.buffer_len + n] = ts[start : start + n]
+            self.buffer_len += n
+            start += n
+            if self.buffer_len >= len(self.buffer):
+                self._append_buffer_to_file()
+
+    def _dataset_options(self, batch):
+        n_channels = len(self.channels)
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            # one chunk per flush, such that each flush writes whole chunks
+            max_rows = max(1, _MAX_CHUNK_BYTES // max(1, n_channels * batch.dtype.itemsize))
+            chunk_size = min(self._buffer_capacity(batch), max_rows)
+
+        options = {"chunks": (int(chunk_size), n_channels), "shuffle": self.shuffle}
+        if self.compression is not None:
+            options["compression"] = self.compression
+            if self.compression == "gzip":
+                options["compression_opts"] = self.compression_level
+        return options
+
+    def _buffer_capacity(self, batch):
+        # staging buffer holds as many samples as allowed by both the sample and byte threshold
+        capacity = self.flush_samples
+        if self.flush_bytes is not None or capacity is None:
+            n_bytes = self.flush_bytes if self.flush_bytes is not None else _FLUSH_BYTES
+            max_rows = n_bytes // max(1, len(self.channels) * batch.dtype.itemsize)
+            capacity = max_rows if capacity is None else min(capacity, max_rows)
+        return max(1, int(capacity))
+
+    def _create_dataset(self, batch):
+        n_channels = len(self.channels)
+        capacity = self._buffer_capacity(batch)
+
+        if self.file_format == "h5":
+            self.segment.dataset = self.segment.file.create_dataset(
+                "data", (0, n_channels), maxshape=(None, n_channels), dtype=batch.dtype, **self._dataset_options(batch)
+            )
+        self._write_meta(batch.dtype)
+        if self.annot_in_h5 and self.annotRuns is not None:
+            self.segment.create_annotation()
+        if self.swmr:
+            # all objects and attributes must exist before switching to SWMR mode
+            self.segment.file.swmr_mode = True
+        if self.buffer is not None:
+            # staging buffers are shared across segments
+            return
+
+        self.buffer = np.empty((capacity, n_channels), dtype=batch.dtype)
+        self.buffer_len = 0
+        if self.async_write:
+            self.spareBuffers = queue.Queue()
+            for _ in range(self.queue_size):
+                self.spareBuffers.put(np.empty_like(self.buffer))
+
+    def _append_buffer_to_file(self, block=False):
+        if self.buffer_len == 0:
+            return
+
+        if self.writer is None:
+            self.segment.write(self.buffer, self.buffer_len, self.growth_factor, self._flush_annotation(self.buffer_len))
+            self.buffer_len = 0
+            return
+
+        # swap buffers, such that new batches are collected while the full buffer is written
+        if self.backpressure == "block" or block:
+            spare = self.spareBuffers.get()
+        else:
+            try:
+                spare = self.spareBuffers.get_nowait()
+            except queue.Empty:
+                # the annotation of the dropped samples is dropped alike, such that later annotation stays aligned
+                self._flush_annotation(self.buffer_len, dropped=True)
+                self.dropped_samples += self.buffer_len
+                self.buffer_len = 0
+                self.warn('Writer queue full, dropping buffer')
+                return
+
+        self.writeQueue.put((self.segment, self.buffer, self.buffer_len, self._flush_annotation(self.buffer_len)))
+        self.buffer, self.buffer_len = spare, 0
+
+    def _flush_annotation(self, n, dropped=False):
+        """Takes the annotation of the next n received samples once they are flushed.
+
+        Returns the annotation rows for table formats. Annotation runs are
+        mapped from received to written samples, i.e. shifted back by the
+        samples dropped before and clipped to the flushed samples if these
+        are written, or removed if they are dropped. Finished runs are
+        written to the .csv file, or returned for `annot_in_h5`.
+        """
+        if self.annotRows is not None:
+            return self._take_annotation(n)
+        if self.annotRuns is None:
+            return None
+
+        start, end = self.segment_flushed, self.segment_flushed + n
+        self.segment_flushed = end
+        if dropped:
+            self.segment_dropped += n
+            self.annotRuns = [run for run in self.annotRuns if run[1] > end]
+            return None
+
+        runs = self.annotRuns
+        if self.last_annotation is not None:
+            runs = runs + [(self.last_annotation[1], self.last_annotation[2], self.last_annotation[0])]
+        finished = []
+        for run_start, run_end, label in runs:
+            run_start, run_end = max(run_start, start) - self.segment_dropped, min(run_end, end) - self.segment_dropped
+            if run_start >= run_end:
+                continue
+            if self.annotOpen is not None and self.annotOpen[2] == label and self.annotOpen[1] == run_start:
+                # run continued from the previous flush, or across dropped samples
+                self.annotOpen = (self.annotOpen[0], run_end, label)
+                continue
+            if self.annotOpen is not None:
+                finished.append(self.annotOpen)
+            self.annotOpen = (run_start, run_end, label)
+        self.annotRuns = [run for run in self.annotRuns if run[1] > end]
+        return self._write_runs(finished)
+
+    def _write_runs(self, runs):
+        # finished runs are written to the .csv file directly, or returned to be appended to the "annot" dataset along with the data
+        if self.outputFileAnnotation is not None:
+            self.outputFileAnnotation.write("".join(f"{s},{e},{self._label(l)}\n" for s, e, l in runs))
+            return None
+        return [(s, e, str(self._label(l))) for s, e, l in runs]
+
+    def _take_annotation(self, n):
+        # annotation rows of the next n samples, as they are received before the samples themselves
+        if self.annotRows is None:
+            return None
+        taken = []
+        while n > 0 and len(self.annotRows) > 0:
+            rows = self.annotRows.pop(0)
+            if len(rows) > n:
+                self.annotRows.insert(0, rows[n:])
+            taken.append(rows[:n])
+            n -= len(taken[-1])
+        if n > 0:
+            # samples without annotation
+            taken.append(np.full(n, ""))
+        return np.concatenate(taken)
+
+    def _stop_writer(self):
+        # drain the queue until the writer reaches the sentinel
+        self.writeQueue.put(None)
+        self.writer.join()
+        self.writer = None
+
+        if self.writerError is not None:
+            self.error('Writer thread failed:', self.writerError)
+        if self.dropped_samples > 0:
+            self.warn(f'Dropped {self.dropped_samples} samples due to full writer queue')
+
+    def _write_worker(self):
+        # items are either a buffer to write to a segment or, if buffer is None, the request to close that segment
+        while (item := self.writeQueue.get()) is not None:
+            segment, buffer, n, annot = item
+            try:
+                if buffer is None:
+                    if annot is not None:
+                        segment.write_annotation(annot)
+                    segment.close()
+                else:
+                    segment.write(buffer, n, self.growth_factor, annot)
+            except Exception as err:
+                # keep consuming, such that process() never blocks on a dead writer
+                self.writerError = err
+            if buffer is not None:
+                self.spareBuffers.put(buffer)
 
     def receive_annotation(self, data_frame, **kwargs):
+        annot = np.asarray(data_frame).reshape(-1)
+        if len(annot) == 0:
+            return
+        if self.annotRows is not None:
+            # table formats store one label per sample
+            self.annotRows.append(annot.astype(str) if self.annot_labels is None else np.asarray(self.annot_labels, dtype=str)[annot.astype(np.int64)])
+            return
         if self.last_annotation is None:
-            self.last_annotation = (data_frame[0], 0, 0)
+            self.last_annotation = (annot[0], 0, 0)
 
-        # Group succeding entries together
-        # TODO: consider using sparcity libraries instead of custom implementation
-        for annotation in data_frame:
-            if annotation == self.last_annotation[0]:
-                self.last_annotation = (annotation, self.last_annotation[1], self.last_annotation[2] + 1)
-            else:
-                self.outputFileAnnotation.write(f"{self.last_annotation[1]},{self.last_annotation[2]},{self.last_annotation[0]}\n")
-                self.last_annotation = (annotation, self.last_annotation[2], self.last_annotation[2] + 1)
+        # Group succeding entries together, the last run is kept open as it may continue in the next batch
+        label, start, end = self.last_annotation
+        changes = np.flatnonzero(annot != np.concatenate(([label], annot[:-1])))
+        starts = [start] + (end + changes).tolist()
+        ends = starts[1:] + [end + len(annot)]
+        labels = [label] + annot[changes].tolist()
+
+        # written once their samples are flushed
+        self.annotRuns.extend(zip(starts[:-1], ends[:-1], labels[:-1]))
+        self.last_annotation = (labels[-1], starts[-1], ends[-1])
+
+    def _label(self, value):
+        # resolve label codes, plain annotation strings are written as is
+        return value if self.annot_labels is None else self.annot_labels[value]
 
     def _read_meta(self):
-        if not os.path.exists(f"{self.outputFilename}.json"):
+        if not os.path.exists(f"{self.segmentFilename}.json"):
             return {}
-        with open(f"{self.outputFilename}.json", 'r') as f:
+        with open(f"{self.segmentFilename}.json", 'r') as f:
             return json.load(f)
 
-    def _write_meta(self, setting):
-        with open(f"{self.outputFilename}.json", 'w') as f:
-            json.dump(setting, f, indent=2)
+    def _write_meta(self, dtype=None):
+        if dtype is None:
+            dtype = self.segment.dataset.dtype if self.file_format == "h5" else self.buffer.dtype
+        setting = {**self.meta, 'channels': [str(x) for x in self.channels], 'dtype': str(dtype)}
+
+        if self.file_format != "h5":
+            # the schema of table formats is fixed once created
+            if self.segment.dataset is None:
+                self.segment.create_schema(self.channels, dtype, setting, self.annotRows is not None)
+            else:
+                self.warn('Cannot update meta of Arrow or Parquet files')
+        elif not self.segment.file.swmr_mode:
+            for key, val in setting.items():
+                self.segment.dataset.attrs[key] = val
+        else:
+            self.warn('Cannot update meta attributes in SWMR mode')
+
+        if self.write_json:
+            with open(f"{self.segmentFilename}.json", 'w') as f:
+                json.dump(setting, f, indent=2)
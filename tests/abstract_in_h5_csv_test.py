@@ -0,0 +1,399 @@
+import asyncio
+import glob
+import json
+import os
+import selectors
+import time
+import h5py
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from ln_io_h5_csv.abstract_in_h5_csv import Abstract_in_h5_csv, _cache
+from ln_io_h5_csv.in_h5_csv import In_h5_csv
+from ln_io_h5_csv.in_playback_h5_csv import In_playback_h5_csv
+
+
+def _expand_annotation_loop(starts, ends, acts, n_samples):
+    # previous row-wise implementation as reference
+    annot = []
+    last_end = 0
+    for start, end, act in zip(starts, ends, acts):
+        annot.append([""] * (start - last_end))
+        annot.append([str(act)] * (end - start))
+        last_end = end
+    annot.append([""] * (n_samples - last_end))
+    return list(np.concatenate(annot))
+
+
+def _random_runs(n_runs, n_samples, seed=0):
+    rng = np.random.default_rng(seed=seed)
+    bounds = np.sort(rng.choice(np.arange(1, n_samples), size=2 * n_runs, replace=False))
+    acts = rng.choice(["Stand", "Walk", "Run", "Jump"], size=n_runs)
+    return bounds[0::2], bounds[1::2], acts
+
+
+def _write_segments(tmp_path, lengths, annotated):
+    segments, offset = [], 0
+    for i, (length, annot) in enumerate(zip(lengths, annotated)):
+        f = f"{tmp_path}/rec.part{i:04d}.h5"
+        with h5py.File(f, 'w') as data_file:
+            data_file.create_dataset("data", data=np.arange(offset, offset + length).reshape(-1, 1))
+        if annot:
+            with open(f.replace(".h5", ".csv"), "w") as csv_file:
+                csv_file.write(f"start,end,act\n1,{length - 1},S{i}\n")
+        segments.append(f)
+        offset += length
+    return segments
+
+
+class TestProcessing:
+
+    @pytest.mark.parametrize("block_size", [1, 4, 7, 100])
+    @pytest.mark.parametrize("annotated", [[True, False, True], [False, False, False]])
+    def test_read_blocks(self, tmp_path, block_size, annotated):
+        segments = _write_segments(tmp_path, [5, 9, 6], annotated)
+        expected_data, _, expected_annot = Abstract_in_h5_csv._read_recording(segments)
+
+        blocks = list(Abstract_in_h5_csv._read_blocks(segments, block_size))
+
+        assert all(len(ts) == block_size for ts, _, _ in blocks[:-1])
+        np.testing.assert_equal(np.concatenate([ts for ts, _, _ in blocks]), expected_data)
+        if any(annotated):
+            np.testing.assert_equal(np.concatenate([annot for _, _, annot in blocks]), expected_annot)
+        else:
+            assert all(len(annot) == 0 for _, _, annot in blocks)
+
+    @pytest.mark.parametrize("options,mapped", [({}, True), ({'chunks': (4, 1)}, False), ({'compression': "gzip"}, False)])
+    def test_map_dataset(self, tmp_path, options, mapped):
+        f = f"{tmp_path}/data.h5"
+        data = np.arange(40, dtype=np.float32).reshape(-1, 2)
+        with h5py.File(f, 'w') as data_file:
+            data_file.create_dataset("data", data=data, **options)
+
+        ts, _, _ = Abstract_in_h5_csv._read_data(f)
+        blocks = [ts for ts, _, _ in Abstract_in_h5_csv._read_blocks([f], 8)]
+
+        np.testing.assert_equal(ts, data)
+        np.testing.assert_equal(np.concatenate(blocks), data)
+        assert isinstance(ts, np.memmap) == mapped
+        assert all(isinstance(block, np.memmap) == mapped for block in blocks)
+        if mapped:
+            assert not ts.flags.writeable
+
+    @pytest.mark.parametrize("columns", [None, [0], [1, 0], [-1, 1, 1]])
+    @pytest.mark.parametrize("rows", [None, (3, 11), (7, None), (None, 5), (18, 30)])
+    def test_read_selection(self, tmp_path, columns, rows):
+        segments = _write_segments(tmp_path, [5, 9, 6], [True, False, True])
+        for f in segments:
+            # second channel, contiguous and chunked
+            with h5py.File(f, 'a') as data_file:
+                data = data_file["data"][:]
+                del data_file["data"]
+                data_file.create_dataset("data", data=np.concatenate([data, -data], axis=1), chunks=(2, 2) if "0001" in f else None)
+        data, _, annot = Abstract_in_h5_csv._read_recording(segments)
+        selected = slice(*rows) if rows is not None else slice(None)
+        expected_data = data[selected] if columns is None else data[selected][:, columns]
+
+        actual_data, channels, actual_annot = Abstract_in_h5_csv._read_recording(segments, columns, rows)
+        blocks = list(Abstract_in_h5_csv._read_blocks(segments, 4, columns, rows))
+
+        np.testing.assert_equal(actual_data, expected_data)
+        np.testing.assert_equal(actual_annot, annot[selected])
+        np.testing.assert_equal(np.concatenate([ts for ts, _, _ in blocks]), expected_data)
+        np.testing.assert_equal(np.concatenate([a for _, _, a in blocks]), annot[selected])
+        # files without channel names keep the default names of the selected channels
+        assert channels == ([str(c % 2) for c in columns] if columns is not None else [])
+
+    def test_select_unknown_channel(self, tmp_path):
+        segments = _write_segments(tmp_path, [5], [False])
+
+        with pytest.raises(ValueError):
+            Abstract_in_h5_csv._read_data(segments[0], ["A"])
+        with pytest.raises(ValueError):
+            In_h5_csv(files=f"{tmp_path}/*.h5", meta={'channels': ["A"]}, select_channels=["B"])
+        with pytest.raises(ValueError):
+            In_h5_csv(files=f"{tmp_path}/*.h5", select_start=1.5, unit="seconds")
+
+    @pytest.mark.parametrize("block_size", [3, 4, 10])
+    def test_read_parquet_row_groups(self, tmp_path, block_size, monkeypatch):
+        f = f"{tmp_path}/data.parquet"
+        data = np.arange(40, dtype=np.float32).reshape(-1, 2)
+        annot = np.repeat(["Stand", "Walk"], [7, 13])
+        pq.write_table(pa.table({"A": data[:, 0], "B": data[:, 1], "annot": annot}), f, row_group_size=4)
+
+        decoded = []
+        read_row_groups = pq.ParquetFile.read_row_groups
+
+        def counting_read_row_groups(parquet_file, row_groups, *args, **kwargs):
+            decoded.extend(row_groups)
+            return read_row_groups(parquet_file, row_groups, *args, **kwargs)
+
+        monkeypatch.setattr(pq.ParquetFile, "read_row_groups", counting_read_row_groups)
+        blocks = list(Abstract_in_h5_csv._read_blocks([f], block_size))
+        ts, channels, actual_annot = Abstract_in_h5_csv._read_data(f, ["B"], (5, 9))
+
+        np.testing.assert_equal(np.concatenate([ts for ts, _, _ in blocks]), data)
+        np.testing.assert_equal(np.concatenate([a for _, _, a in blocks]), annot)
+        # blocks only decode the row groups they overlap, those spanning two blocks at most twice
+        assert sorted(set(decoded[:-2])) == [0, 1, 2, 3, 4]
+        assert all(decoded[:-2].count(group) <= 2 for group in range(5))
+        np.testing.assert_equal(ts, data[5:9, 1:])
+        np.testing.assert_equal(actual_annot, annot[5:9])
+        assert channels == ["B"]
+        assert decoded[-2:] == [1, 2]
+
+    @pytest.mark.parametrize("select_start,select_stop", [(-3, None), (None, -2)])
+    def test_select_negative(self, tmp_path, select_start, select_stop):
+        with pytest.raises(ValueError):
+            In_h5_csv(files=f"{tmp_path}/*.h5", select_start=select_start, select_stop=select_stop)
+
+    @pytest.mark.parametrize("depth", [0, 2])
+    def test_prefetched(self, depth):
+        node = In_playback_h5_csv(files="", meta={'sample_rate': 1})
+
+        class Counting_selector(selectors.DefaultSelector):
+            # the event loop waits on its selector once per iteration
+            wakeups = 0
+
+            def select(self, timeout=None):
+                Counting_selector.wakeups += 1
+                return super().select(timeout)
+
+        def slow():
+            for i in range(3):
+                time.sleep(0.3)
+                yield i
+
+        async def consume():
+            return [item async for item in node._prefetched(slow(), depth)]
+
+        loop = asyncio.SelectorEventLoop(Counting_selector())
+        try:
+            items = loop.run_until_complete(consume())
+        finally:
+            loop.close()
+        assert items == [0, 1, 2]
+        # the consumer sleeps until an item is handed over instead of polling
+        assert Counting_selector.wakeups < 50
+
+    def test_expand_annotation(self):
+        starts, ends, acts = [0, 5, 7, 8, 10, 13], [5, 7, 8, 10, 13, 20], ["1", "2", "3", "1", "2", "3"]
+        expected = ["1"] * 5 + ["2"] * 2 + ["3"] * 1 + ["1"] * 2 + ["2"] * 3 + ["3"] * 7
+
+        np.testing.assert_equal(Abstract_in_h5_csv._expand_annotation(starts, ends, acts, 20), expected)
+
+    def test_expand_annotation_gaps(self):
+        starts, ends, acts = _random_runs(n_runs=50, n_samples=1000)
+
+        actual = Abstract_in_h5_csv._expand_annotation(starts, ends, acts, 1000)
+
+        assert isinstance(actual, np.ndarray)
+        np.testing.assert_equal(actual, _expand_annotation_loop(starts, ends, acts, 1000))
+
+    def test_expand_annotation_numeric_labels(self):
+        actual = Abstract_in_h5_csv._expand_annotation(np.array([1]), np.array([3]), np.array([7]), 4)
+
+        np.testing.assert_equal(actual, ["", "7", "7", ""])
+
+    def test_expand_annotation_many_runs(self):
+        n_samples = 1_000_000
+        starts, ends, acts = _random_runs(n_runs=5000, n_samples=n_samples)
+
+        expected = _expand_annotation_loop(starts, ends, acts, n_samples)
+        actual = Abstract_in_h5_csv._expand_annotation(starts, ends, acts, n_samples)
+
+        np.testing.assert_equal(actual, expected)
+
+
+class TestCache:
+
+    @pytest.fixture(autouse=True)
+    def reads(self, monkeypatch):
+        _cache.clear()
+        reads = []
+        read_data = Abstract_in_h5_csv._read_data
+
+        def counting_read_data(f, *args):
+            reads.append(f)
+            return read_data(f, *args)
+
+        monkeypatch.setattr(Abstract_in_h5_csv, "_read_data", staticmethod(counting_read_data))
+        yield reads
+        _cache.clear()
+
+    def test_hit(self, tmp_path, reads):
+        segments = _write_segments(tmp_path, [20], [True])
+
+        first = In_h5_csv(files=f"{tmp_path}/*.h5", cache_bytes=1024)._load_recording(segments)
+        # e.g. a restarted graph with a new node instance
+        second = In_h5_csv(files=f"{tmp_path}/*.h5", cache_bytes=1024)._load_recording(segments)
+
+        assert len(reads) == 1
+        assert second[0] is first[0]
+        assert not second[0].flags.writeable
+
+    def test_disabled(self, tmp_path, reads):
+        segments = _write_segments(tmp_path, [20], [True])
+        node = In_h5_csv(files=f"{tmp_path}/*.h5")
+
+        node._load_recording(segments)
+        node._load_recording(segments)
+
+        assert len(reads) == 2
+        assert len(_cache.entries) == 0
+
+    def test_modified(self, tmp_path, reads):
+        segments = _write_segments(tmp_path, [20], [False])
+        node = In_h5_csv(files=f"{tmp_path}/*.h5", cache_bytes=1024)
+
+        node._load_recording(segments)
+        with h5py.File(segments[0], 'w') as data_file:
+            data_file.create_dataset("data", data=np.zeros((3, 1)))
+        os.utime(segments[0], ns=(time.time_ns(), time.time_ns() + 10**9))
+        ts, _, _ = node._load_recording(segments)
+
+        assert len(reads) == 2
+        np.testing.assert_equal(ts, np.zeros((3, 1)))
+
+    def test_budget(self, tmp_path, reads):
+        recordings = []
+        for i in range(3):
+            (tmp_path / str(i)).mkdir()
+            recordings.append(_write_segments(tmp_path / str(i), [10], [False]))
+        # each recording holds 10 int64 samples
+        node = In_h5_csv(files=f"{tmp_path}/*.h5", cache_bytes=200)
+
+        for segments in recordings + recordings[-1:]:
+            node._load_recording(segments)
+        node._load_recording(recordings[0])
+
+        assert _cache.n_bytes <= 200
+        assert len(reads) == 4
+
+    def test_load_blocks(self, tmp_path, reads):
+        segments = _write_segments(tmp_path, [5, 9, 6], [True, False, True])
+        node = In_h5_csv(files=f"{tmp_path}/*.h5", cache_bytes=1024)
+
+        blocks = list(node._load_blocks(segments, 4))
+        cached_blocks = list(node._load_blocks(segments, 4))
+
+        assert len(reads) == 3
+        for (ts, _, annot), (expected_ts, _, expected_annot) in zip(cached_blocks, Abstract_in_h5_csv._read_blocks(segments, 4)):
+            np.testing.assert_equal(ts, expected_ts)
+            np.testing.assert_equal(annot, expected_annot)
+        assert len(blocks) == len(cached_blocks) == 5
+
+
+class TestIndex:
+
+    @pytest.fixture
+    def infos_read(self, monkeypatch):
+        read = []
+        file_info = Abstract_in_h5_csv._file_info.__func__
+
+        def counting_file_info(cls, f):
+            read.append(f)
+            return file_info(cls, f)
+
+        monkeypatch.setattr(Abstract_in_h5_csv, "_file_info", classmethod(counting_file_info))
+        return read
+
+    def test_build(self, tmp_path, infos_read):
+        segments = _write_segments(tmp_path, [5, 9, 6], [True, False, True])
+        node = In_h5_csv(files=f"{tmp_path}/*.h5", index=f"{tmp_path}/index.json")
+
+        infos = node._recording_infos([segments])
+
+        assert infos == [{'n_samples': 20, 'n_bytes': sum(map(os.path.getsize, segments)), 'n_channels': 1, 'dtype': 'int64', 'channels': [], 'labels': ["S0", "S2"]}]
+        with open(f"{tmp_path}/index.json") as f:
+            assert sorted(json.load(f)['files']) == sorted(map(os.path.abspath, segments))
+
+        # e.g. a restarted graph only reads files modified since
+        os.utime(segments[1], ns=(time.time_ns(), time.time_ns() + 10**9))
+        assert In_h5_csv(files=f"{tmp_path}/*.h5", index=f"{tmp_path}/index.json")._recording_infos([segments]) == infos
+        assert infos_read == segments + segments[1:2]
+
+    def test_prune(self, tmp_path, infos_read):
+        segments = _write_segments(tmp_path, [5, 9], [False, False])
+        node = In_h5_csv(files=f"{tmp_path}/*.h5", index=f"{tmp_path}/index.json")
+
+        node._recording_infos([segments[:1], segments[1:]])
+        os.remove(segments[1])
+        node._recording_infos([segments[:1]])
+
+        with open(f"{tmp_path}/index.json") as f:
+            assert list(json.load(f)['files']) == [os.path.abspath(segments[0])]
+
+    def test_unreadable(self, tmp_path, infos_read):
+        segments = _write_segments(tmp_path, [5, 9], [False, False])
+        with open(segments[1], 'rb') as f:
+            content = f.read()
+        with open(segments[1], 'wb') as f:
+            f.write(b"not yet written")
+        node = In_h5_csv(files=f"{tmp_path}/*.h5", index=f"{tmp_path}/index.json")
+
+        infos = node._recording_infos([segments[:1], segments[1:]])
+
+        assert [info['n_samples'] for info in infos] == [5, 0]
+        with open(f"{tmp_path}/index.json") as f:
+            assert list(json.load(f)['files']) == [os.path.abspath(segments[0])]
+
+        # read again on the next run, although not modified since
+        stat = os.stat(segments[1])
+        with open(segments[1], 'wb') as f:
+            f.write(content)
+        os.utime(segments[1], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert [info['n_samples'] for info in node._recording_infos([segments[:1], segments[1:]])] == [5, 9]
+        assert infos_read == segments + segments[1:]
+
+    @pytest.mark.parametrize("meta", [{}, {'channels': ["A"]}])
+    def test_channel_mismatch(self, tmp_path, meta):
+        recordings = []
+        for i, n_channels in enumerate([1, 2]):
+            with h5py.File(f := f"{tmp_path}/rec{i}.h5", 'w') as data_file:
+                data_file.create_dataset("data", data=np.zeros((5, n_channels)))
+            recordings.append([f])
+        node = In_h5_csv(files=f"{tmp_path}/*.h5", meta=meta, index=f"{tmp_path}/index.json")
+
+        with pytest.raises(ValueError):
+            node._recording_infos(recordings)
+
+
+class TestShard:
+    @pytest.fixture
+    def recordings(self, tmp_path):
+        sizes = [1000, 200, 800, 400, 600, 300, 100, 500]
+        for i, n_samples in enumerate(sizes):
+            with h5py.File(f"{tmp_path}/rec{i}.h5", 'w') as f:
+                f.create_dataset("data", data=np.zeros((n_samples, 4)))
+        return sizes
+
+    @pytest.mark.parametrize("shard_count", [1, 2, 3, 8, 10])
+    def test_partition(self, tmp_path, recordings, shard_count):
+        shards = [In_h5_csv(files=f"{tmp_path}/*.h5", shard_index=i, shard_count=shard_count)._glob_recordings() for i in range(shard_count)]
+
+        files = [f for shard in shards for segments in shard for f in segments]
+        # each recording is read by exactly one shard
+        assert sorted(files) == sorted(f for segments in In_h5_csv(files=f"{tmp_path}/*.h5")._glob_recordings() for f in segments)
+
+        loads = [sum(os.path.getsize(f) for segments in shard for f in segments) for shard in shards]
+        if shard_count <= len(recordings):
+            # greedy assignment is within the largest recording of perfect balance
+            assert max(loads) - min(loads) <= max(os.path.getsize(f) for f in files)
+
+    def test_deterministic(self, tmp_path, recordings, monkeypatch):
+        first = In_h5_csv(files=f"{tmp_path}/*.h5", shard_index=1, shard_count=3)._glob_recordings()
+
+        # assignment does not depend on glob order
+        glob_orig = glob.glob
+        monkeypatch.setattr(glob, "glob", lambda pattern: sorted(glob_orig(pattern), reverse=True))
+        second = In_h5_csv(files=f"{tmp_path}/*.h5", shard_index=1, shard_count=3)._glob_recordings()
+
+        assert sorted(first) == sorted(second)
+
+    @pytest.mark.parametrize("shard_index,shard_count", [(2, 2), (-1, 2), (0, 0)])
+    def test_invalid(self, tmp_path, shard_index, shard_count):
+        with pytest.raises(ValueError):
+            In_h5_csv(files=f"{tmp_path}/*.h5", shard_index=shard_index, shard_count=shard_count)
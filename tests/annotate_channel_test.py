@@ -15,14 +15,15 @@ class Results(NamedTuple):
     ts: np.ndarray
     channels: np.ndarray
     annot: np.ndarray
+    annot_labels: list
 
 
-def _run_test_pipeline(data, channels):
+def _run_test_pipeline(data, channels, **kwargs):
     data_in = In_python(name="A", data=data)
     # Channels defined here not part of test; only needed for Out_h5_csv to work
     channels_in = In_python(name="B", data=channels)
 
-    annotate_channel = Annotate_channel(channel_name="Annot", targets=["Idle", "Tap"])
+    annotate_channel = Annotate_channel(channel_name="Annot", targets=["Idle", "Tap"], **kwargs)
     annotate_channel.add_input(data_in, emit_port=data_in.ports_out.any, recv_port=annotate_channel.ports_in.ts)
     annotate_channel.add_input(channels_in, emit_port=channels_in.ports_out.any, recv_port=annotate_channel.ports_in.channels)
 
@@ -35,12 +36,15 @@ def _run_test_pipeline(data, channels):
     collect_annot = Out_python(name="E")
     collect_annot.add_input(annotate_channel, emit_port=annotate_channel.ports_out.annot, recv_port=collect_annot.ports_in.any)
 
+    collect_labels = Out_python(name="F")
+    collect_labels.add_input(annotate_channel, emit_port=annotate_channel.ports_out.annot_labels, recv_port=collect_labels.ports_in.any)
+
     g = Graph(start_node=data_in)
     g.start_all()
     g.join_all()
     g.stop_all()
 
-    return Results(collect_data.get_state(), collect_channels.get_state(), collect_annot.get_state())
+    return Results(collect_data.get_state(), collect_channels.get_state(), collect_annot.get_state(), collect_labels.get_state())
 
 
 class TestProcessing:
@@ -57,7 +61,7 @@ class TestProcessing:
         channels = np.array([["CH1", "CH2", "CH3", "CH4", "CH5", "Annot"]])
         expected_channels = channels[:, :-1]
 
-        actual_data, actual_channels, actual_annot = _run_test_pipeline(merged_data, channels)
+        actual_data, actual_channels, actual_annot, _ = _run_test_pipeline(merged_data, channels)
 
         np.testing.assert_equal(actual_data, data)
         np.testing.assert_equal(actual_channels, expected_channels)
@@ -75,7 +79,7 @@ class TestProcessing:
         channels = np.array([["CH1", "CH2", "CH3", "CH4", "CH5", "Annot"]])
         expected_channels = channels[:, :-1]
 
-        actual_data, actual_channels, actual_annot = _run_test_pipeline(merged_data, channels)
+        actual_data, actual_channels, actual_annot, _ = _run_test_pipeline(merged_data, channels)
 
         np.testing.assert_equal(actual_data, data)
         np.testing.assert_equal(actual_channels, expected_channels)
@@ -93,7 +97,7 @@ class TestProcessing:
         channels = np.array([["CH1", "CH2", "CH3", "CH4", "CH5", "Annot"]])
         expected_channels = channels[:, :-1]
 
-        actual_data, actual_channels, actual_annot = _run_test_pipeline(merged_data, channels)
+        actual_data, actual_channels, actual_annot, _ = _run_test_pipeline(merged_data, channels)
 
         np.testing.assert_equal(actual_data, data)
         np.testing.assert_equal(actual_channels, expected_channels)
@@ -111,7 +115,7 @@ class TestProcessing:
         channels = np.array([["Annot", "CH1", "CH2", "CH3", "CH4", "CH5"]])
         expected_channels = channels[:, 1:]
 
-        actual_data, actual_channels, actual_annot = _run_test_pipeline(merged_data, channels)
+        actual_data, actual_channels, actual_annot, _ = _run_test_pipeline(merged_data, channels)
 
         np.testing.assert_equal(actual_data, data)
         np.testing.assert_equal(actual_channels, expected_channels)
@@ -132,8 +136,24 @@ class TestProcessing:
         channels = np.array([["CH1", "CH2", "Annot", "CH3", "CH4", "CH5"]])
         expected_channels = np.delete(channels, 2, axis=1)
 
-        actual_data, actual_channels, actual_annot = _run_test_pipeline(merged_data, channels)
+        actual_data, actual_channels, actual_annot, _ = _run_test_pipeline(merged_data, channels)
 
         np.testing.assert_equal(actual_data, expected_data)
         np.testing.assert_equal(actual_channels, expected_channels)
         np.testing.assert_equal(actual_annot, expected_annot)
+
+    def test_categorical(self):
+        data = np.arange(500).reshape((50, 2, 5))
+
+        rng = np.random.default_rng(seed=4)
+        annot = rng.integers(low=0, high=2, size=(50, 2, 1))
+
+        merged_data = np.append(data, annot, axis=2)
+
+        channels = np.array([["CH1", "CH2", "CH3", "CH4", "CH5", "Annot"]])
+
+        actual_data, _, actual_annot, actual_labels = _run_test_pipeline(merged_data, channels, categorical=True)
+
+        np.testing.assert_equal(actual_data, data)
+        np.testing.assert_equal(actual_annot, annot.reshape(50, 2))
+        np.testing.assert_equal(actual_labels, [["Idle", "Tap"]])
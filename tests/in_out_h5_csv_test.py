@@ -4,6 +4,13 @@ from pathlib import Path
 import pytest
 import os
 import numpy as np
+import h5py
+import pyarrow as pa
+import pyarrow.parquet as pq
+import io
+import json
+import threading
+import time
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -21,13 +28,14 @@ class Out_nodes(NamedTuple):
     channels: Out_python
     annot: Out_python
     percent: Out_python
+    annot_labels: Out_python
 
 
 # Example annotation includes small 1 and 2 size blocks to test these edge cases.
 _anot = ["1"] * 5 + ["2"] * 2 + ["3"] * 1 + ["1"] * 2 + ["2"] * 3 + ["3"] * 7
 
 
-def _prepare_data(tmp_path, generate_annot=False):
+def _prepare_data(tmp_path, generate_annot=False, **kwargs):
     data = np.arange(100).reshape((1, 20, 5))  # 20 samples with 5 channels each
 
     data_in = In_python(name="A", data=data)
@@ -36,7 +44,7 @@ def _prepare_data(tmp_path, generate_annot=False):
     collect_data = Out_python(name="B")
     collect_data.add_input(data_in, emit_port=data_in.ports_out.any, recv_port=collect_data.ports_in.any)
 
-    write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/")
+    write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/", **kwargs)
     write_data.add_input(data_in, emit_port=data_in.ports_out.any, recv_port=write_data.ports_in.ts)
     write_data.add_input(channels_in, emit_port=channels_in.ports_out.any, recv_port=write_data.ports_in.channels)
 
@@ -52,8 +60,28 @@ def _prepare_data(tmp_path, generate_annot=False):
     return collect_data.get_state()
 
 
-def _run_test_pipeline(tmp_path, channel_names=None):
-    read_data = In_h5_csv(name="A", files=f"{tmp_path}/*.h5", meta={'channels': channel_names})
+def _write_batches(tmp_path, data, annot, annot_labels=None, **kwargs):
+    data_in = In_python(name="A", data=data)
+    channels_in = In_python(name="Channels", data=[["A", "B", "C", "D", "E"]])
+    annot_in = In_python(name="D", data=annot)
+
+    write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/", **kwargs)
+    write_data.add_input(data_in, emit_port=data_in.ports_out.any, recv_port=write_data.ports_in.ts)
+    write_data.add_input(channels_in, emit_port=channels_in.ports_out.any, recv_port=write_data.ports_in.channels)
+    write_data.add_input(annot_in, emit_port=annot_in.ports_out.any, recv_port=write_data.ports_in.annot)
+
+    if annot_labels is not None:
+        labels_in = In_python(name="E", data=[annot_labels])
+        write_data.add_input(labels_in, emit_port=labels_in.ports_out.any, recv_port=write_data.ports_in.annot_labels)
+
+    g = Graph(start_node=data_in)
+    g.start_all()
+    g.join_all()
+    g.stop_all()
+
+
+def _run_test_pipeline(tmp_path, channel_names=None, extension=".h5", meta=None, **kwargs):
+    read_data = In_h5_csv(name="A", files=f"{tmp_path}/*{extension}", meta={'channels': channel_names} if meta is None else meta, **kwargs)
 
     collect_data = Out_python(name="B")
     collect_data.add_input(read_data, emit_port=read_data.ports_out.ts, recv_port=collect_data.ports_in.any)
@@ -67,12 +95,15 @@ def _run_test_pipeline(tmp_path, channel_names=None):
     collect_percent = Out_python(name="D")
     collect_percent.add_input(read_data, emit_port=read_data.ports_out.percent, recv_port=collect_percent.ports_in.any)
 
+    collect_labels = Out_python(name="E")
+    collect_labels.add_input(read_data, emit_port=read_data.ports_out.annot_labels, recv_port=collect_labels.ports_in.any)
+
     g = Graph(start_node=read_data)
     g.start_all()
     g.join_all()
     g.stop_all()
 
-    return Out_nodes(collect_data, collect_channels, collect_anot, collect_percent)
+    return Out_nodes(collect_data, collect_channels, collect_anot, collect_percent, collect_labels)
 
 
 class TestProcessing:
@@ -92,13 +123,17 @@ class TestProcessing:
 
     def test_channels_no_json(self, tmp_path):
 
-        expected_data = _prepare_data(tmp_path)
+        expected_data = _prepare_data(tmp_path, write_json=True)
 
         files = glob(str(Path(tmp_path).joinpath('*.json')))
         assert len(files) == 1
         file = Path(tmp_path).joinpath(files[0])
         os.remove(file)
 
+        # files written by previous versions only contain the data
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'a') as f:
+            del f['data'].attrs['channels']
+
         expected_channels = ["0", "1", "2", "3", "4"]
 
         results = _run_test_pipeline(tmp_path)
@@ -109,6 +144,26 @@ class TestProcessing:
         np.testing.assert_equal(actual_data, expected_data)
         np.testing.assert_equal(actual_channels, expected_channels)
 
+    def test_channels_json_only(self, tmp_path):
+        expected_data = _prepare_data(tmp_path, write_json=True)
+
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'a') as f:
+            del f['data'].attrs['channels']
+
+        results = _run_test_pipeline(tmp_path)
+
+        np.testing.assert_equal(np.array(results.ts.get_state()), expected_data)
+        np.testing.assert_equal(results.channels.get_state()[0], ["A", "B", "C", "D", "E"])
+
+    def test_meta_attributes(self, tmp_path):
+        _prepare_data(tmp_path, meta={'sample_rate': 1000})
+
+        assert len(glob(f"{tmp_path}/*.json")) == 0
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'r') as f:
+            assert list(f['data'].attrs['channels']) == ["A", "B", "C", "D", "E"]
+            assert f['data'].attrs['sample_rate'] == 1000
+            assert f['data'].attrs['dtype'] == str(f['data'].dtype)
+
     def test_overwrite_channels(self, tmp_path):
 
         expected_data = _prepare_data(tmp_path)
@@ -154,6 +209,62 @@ class TestProcessing:
 
         np.testing.assert_equal(actual_annot, np.array(_anot).reshape(-1, 1))
 
+    @pytest.mark.parametrize("swmr", [False, True])
+    def test_annot_in_h5(self, tmp_path, swmr):
+        _prepare_data(tmp_path, generate_annot=True, annot_in_h5=True, swmr=swmr)
+
+        assert len(glob(f"{tmp_path}/*.csv")) == 0
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'r') as f:
+            assert f['annot'].shape == (6, 3)
+            assert list(f['annot_labels'].asstr()[:]) == ["1", "2", "3"]
+
+        results = _run_test_pipeline(tmp_path)
+
+        np.testing.assert_equal(results.annot.get_state()[0], np.array(_anot).reshape(-1, 1))
+
+    @pytest.mark.parametrize("async_write", [False, True])
+    def test_annot_in_h5_flush(self, tmp_path, monkeypatch, async_write):
+        write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/", annot_in_h5=True, flush_samples=4, async_write=async_write)
+        monkeypatch.setattr(write_data, "_is_input_connected", lambda port: True)
+        write_data._onstart()
+        write_data.process(ts=np.zeros((4, 2)), channels=["A", "B"], annot=["a"] * 2 + ["b"] * 2)
+        write_data.process(ts=np.zeros((4, 2)), annot=["c"] * 4)
+        while async_write and write_data.spareBuffers.qsize() < write_data.queue_size:
+            # wait for the writer to return all written buffers
+            time.sleep(0.01)
+
+        # finished runs are appended with each flush, the open run once it is finished
+        np.testing.assert_equal(write_data.segment.annot[:], [[0, 2, 0], [2, 4, 1]])
+        assert list(write_data.segment.annot_labels.asstr()[:]) == ["a", "b"]
+
+        write_data._onstop()
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'r') as f:
+            np.testing.assert_equal(f['annot'][:], [[0, 2, 0], [2, 4, 1], [4, 8, 2]])
+            assert list(f['annot_labels'].asstr()[:]) == ["a", "b", "c"]
+
+    def test_annot_categorical(self, tmp_path):
+        for _ in range(2):
+            _prepare_data(tmp_path, generate_annot=True)
+
+        results = _run_test_pipeline(tmp_path, categorical=True)
+
+        labels = results.annot_labels.get_state()
+        assert len(labels) == 1
+        for actual_annot in results.annot.get_state():
+            assert np.issubdtype(actual_annot.dtype, np.integer)
+            np.testing.assert_equal(np.array(labels[0])[actual_annot], np.array(_anot).reshape(-1, 1))
+
+    @pytest.mark.parametrize("annot_in_h5", [False, True])
+    def test_annot_codes(self, tmp_path, annot_in_h5):
+        data = np.arange(100, dtype=np.int64).reshape((10, 2, 5))
+        labels = ["Stand", "Walk", "Run"]
+        codes = np.array([0] * 5 + [1] * 7 + [2] * 8).reshape((10, 2))
+
+        _write_batches(tmp_path, data, codes, annot_labels=labels, annot_in_h5=annot_in_h5)
+
+        results = _run_test_pipeline(tmp_path)
+        np.testing.assert_equal(results.annot.get_state()[0], np.array(labels)[codes.reshape(-1, 1)])
+
     def test_annot_empty(self, tmp_path):
         _prepare_data(tmp_path)
 
@@ -183,3 +294,281 @@ class TestProcessing:
         actual_percent = results.percent.get_state()
 
         np.testing.assert_equal(actual_percent, expected_percent)
+
+    @pytest.mark.parametrize("backend,prefetch", [("threads", None), ("threads", 0), ("processes", 3)])
+    def test_workers(self, tmp_path, backend, prefetch):
+        for i in range(6):
+            with h5py.File(f"{tmp_path}/rec{i}.h5", 'w') as f:
+                f.create_dataset("data", data=np.full((10 + i, 5), i))
+            with open(f"{tmp_path}/rec{i}.csv", 'w') as f:
+                f.write(f"start,end,act\n0,{10 + i},A{i}\n")
+        order = [int(Path(segments[0]).stem[3:]) for segments in In_h5_csv(files=f"{tmp_path}/*.h5")._glob_recordings()]
+
+        results = _run_test_pipeline(tmp_path, workers=2, backend=backend, prefetch=prefetch)
+
+        actual_data = results.ts.get_state()
+        actual_annot = results.annot.get_state()
+        assert [ts[0, 0] for ts in actual_data] == order
+        assert [len(ts) for ts in actual_data] == [10 + i for i in order]
+        assert [annot[0, 0] for annot in actual_annot] == [f"A{i}" for i in order]
+        np.testing.assert_equal(results.percent.get_state(), [round((i + 1) / 6, 2) for i in range(6)])
+
+    def test_shards(self, tmp_path):
+        for i, n_samples in enumerate([40, 10, 30, 20]):
+            with h5py.File(f"{tmp_path}/rec{i}.h5", 'w') as f:
+                f.create_dataset("data", data=np.full((n_samples, 5), i))
+
+        shards = [_run_test_pipeline(tmp_path, shard_index=i, shard_count=2) for i in range(2)]
+
+        # 40 + 10 and 30 + 20 samples
+        assert [sorted(len(ts) for ts in shard.ts.get_state()) for shard in shards] == [[10, 40], [20, 30]]
+        # percent is reported per shard
+        assert [shard.percent.get_state() for shard in shards] == [[0.5, 1.0], [0.5, 1.0]]
+
+    def test_percent_index(self, tmp_path):
+        for i, n_samples in enumerate([10, 30, 60]):
+            with h5py.File(f"{tmp_path}/rec{i}.h5", 'w') as f:
+                f.create_dataset("data", data=np.zeros((n_samples, 5)))
+
+        results = _run_test_pipeline(tmp_path, index=f"{tmp_path}/index.json")
+
+        n_samples = [len(ts) for ts in results.ts.get_state()]
+        np.testing.assert_equal(results.percent.get_state(), np.round(np.cumsum(n_samples) / 100, 2))
+        assert os.path.exists(f"{tmp_path}/index.json")
+
+    @pytest.mark.parametrize("file_format", ["h5", "arrow"])
+    def test_selection(self, tmp_path, file_format):
+        data = np.arange(200).reshape((8, 5, 5))
+        annot = [["Run"] * 5 if i < 3 else ["Walk"] * 5 for i in range(8)]
+        _write_batches(tmp_path, data, annot, file_format=file_format)
+
+        results = _run_test_pipeline(
+            tmp_path,
+            extension=f".{file_format}",
+            select_channels=["Y", 1],
+            select_start=0.1,
+            select_stop=0.3,
+            unit="seconds",
+            meta={'channels': ["V", "W", "X", "Y", "Z"], 'sample_rate': 100},
+        )
+
+        np.testing.assert_equal(results.ts.get_state()[0], data.reshape((40, 5))[10:30, [3, 1]])
+        np.testing.assert_equal(results.channels.get_state()[0], ["Y", "W"])
+        np.testing.assert_equal(results.annot.get_state()[0], np.concatenate(annot)[10:30].reshape(-1, 1))
+
+    def test_max_samples_per_batch(self, tmp_path):
+        expected_data = np.concatenate([np.array(_prepare_data(tmp_path, generate_annot=True)).reshape(20, 5) for _ in range(2)])
+
+        results = _run_test_pipeline(tmp_path, max_samples_per_batch=6)
+
+        actual_data = results.ts.get_state()
+        assert [len(ts) for ts in actual_data] == [6, 6, 6, 2] * 2
+        np.testing.assert_equal(np.concatenate(actual_data), expected_data)
+        np.testing.assert_equal(np.concatenate(results.annot.get_state()), np.array(_anot * 2).reshape(-1, 1))
+        np.testing.assert_equal(results.percent.get_state(), [0.15, 0.3, 0.45, 0.5, 0.65, 0.8, 0.95, 1.0])
+
+    @pytest.mark.parametrize("file_format", ["arrow", "parquet"])
+    @pytest.mark.parametrize("async_write", [False, True])
+    def test_file_format(self, tmp_path, file_format, async_write):
+        data = np.arange(200).reshape((8, 5, 5))
+        annot = [list(np.repeat(["Stand", "Walk"], [3, 2])) if i % 2 else ["Run"] * 5 for i in range(8)]
+        _write_batches(tmp_path, data, annot, file_format=file_format, async_write=async_write, flush_samples=7, meta={'sample_rate': 100})
+
+        files = glob(f"{tmp_path}/*.{file_format}")
+        assert len(files) == 1
+        assert len(glob(f"{tmp_path}/*.csv")) == 0
+        table = pa.ipc.open_file(files[0]).read_all() if file_format == "arrow" else pq.read_table(files[0])
+        assert table.column_names == ["A", "B", "C", "D", "E", "annot"]
+        assert pa.types.is_dictionary(table.schema.field("annot").type)
+        assert json.loads(table.schema.metadata[b'sample_rate']) == 100
+
+        results = _run_test_pipeline(tmp_path, extension=f".{file_format}")
+
+        np.testing.assert_equal(np.array(results.ts.get_state()), data.reshape((1, 40, 5)))
+        np.testing.assert_equal(results.channels.get_state()[0], ["A", "B", "C", "D", "E"])
+        np.testing.assert_equal(results.annot.get_state()[0], np.concatenate(annot).reshape(-1, 1))
+
+    def test_file_format_rotate(self, tmp_path):
+        data = np.arange(200).reshape((8, 5, 5))
+        annot = [["Run"] * 5 if i < 3 else ["Walk"] * 5 for i in range(8)]
+        _write_batches(tmp_path, data, annot, file_format="arrow", rotate_samples=15)
+
+        assert len(glob(f"{tmp_path}/*.arrow")) == 3
+
+        results = _run_test_pipeline(tmp_path, extension=".arrow")
+
+        np.testing.assert_equal(np.array(results.ts.get_state()), data.reshape((1, 40, 5)))
+        np.testing.assert_equal(results.annot.get_state()[0], np.concatenate(annot).reshape(-1, 1))
+
+    def test_file_format_unknown(self, tmp_path):
+        with pytest.raises(ValueError):
+            Out_h5_csv(name="C", folder=f"{tmp_path}/", file_format="csv")
+        with pytest.raises(ValueError):
+            Out_h5_csv(name="C", folder=f"{tmp_path}/", file_format="arrow", swmr=True)
+
+    def test_workers_unknown_backend(self, tmp_path):
+        with pytest.raises(ValueError):
+            In_h5_csv(name="A", files=f"{tmp_path}/*.h5", workers=2, backend="cluster")
+
+    def test_chunking_default(self, tmp_path):
+        expected_data = _prepare_data(tmp_path)
+
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'r') as f:
+            assert f['data'].chunks is not None
+            assert f['data'].compression is None
+
+        results = _run_test_pipeline(tmp_path)
+        np.testing.assert_equal(np.array(results.ts.get_state()), expected_data)
+
+    @pytest.mark.parametrize("compression", ["gzip", "lzf"])
+    def test_compression(self, tmp_path, compression):
+        expected_data = _prepare_data(tmp_path, chunk_size=8, compression=compression, compression_level=6, shuffle=True)
+
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'r') as f:
+            assert f['data'].chunks == (8, 5)
+            assert f['data'].compression == compression
+            assert f['data'].shuffle
+
+        results = _run_test_pipeline(tmp_path)
+        np.testing.assert_equal(np.array(results.ts.get_state()), expected_data)
+
+    def test_compression_unknown(self, tmp_path):
+        with pytest.raises(ValueError):
+            Out_h5_csv(name="C", folder=f"{tmp_path}/", compression="zstd")
+
+    @pytest.mark.parametrize("async_write", [False, True])
+    @pytest.mark.parametrize("flush_samples", [None, 3, 7])
+    def test_many_batches(self, tmp_path, async_write, flush_samples):
+        data = np.arange(3000).reshape((300, 2, 5))
+
+        write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/", flush_samples=flush_samples, async_write=async_write, queue_size=1)
+        write_data._onstart()
+        write_data.process(ts=data[0], channels=["A", "B", "C", "D", "E"])
+        for batch in data[1:]:
+            write_data.process(ts=batch)
+        write_data._onstop()
+
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'r') as f:
+            # geometric growth is trimmed on stop
+            assert f['data'].shape == (600, 5)
+            np.testing.assert_equal(f['data'][:], data.reshape((600, 5)))
+
+    @pytest.mark.parametrize("flush", [{"flush_bytes": 40}, {"flush_bytes": 1, "flush_samples": 100}, {"flush_seconds": 0}])
+    def test_flush_policy(self, tmp_path, flush):
+        data = np.arange(100, dtype=np.int64).reshape((10, 2, 5))
+
+        write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/", **flush)
+        write_data._onstart()
+        write_data.process(ts=data[0], channels=["A", "B", "C", "D", "E"])
+
+        # each threshold is hit by the first batch already
+        assert write_data.buffer_len == 0
+        assert write_data.segment.n_written == 2
+
+        for batch in data[1:]:
+            write_data.process(ts=batch)
+        write_data._onstop()
+
+        with h5py.File(glob(f"{tmp_path}/*.h5")[0], 'r') as f:
+            np.testing.assert_equal(f['data'][:], data.reshape((20, 5)))
+
+    @pytest.mark.parametrize(
+        "rotate",
+        [
+            {"rotate_samples": 3},
+            {"rotate_bytes": 5 * 8 * 3},
+            {"rotate_samples": 3, "async_write": True, "queue_size": 1},
+            {"rotate_samples": 3, "annot_in_h5": True},
+        ],
+    )
+    def test_rotate(self, tmp_path, rotate):
+        data = np.arange(100, dtype=np.int64).reshape((10, 2, 5))
+        annot = np.array(_anot).reshape((10, 2))
+
+        _write_batches(tmp_path, data, annot, **rotate)
+
+        segments = sorted(glob(f"{tmp_path}/*.part*.h5"))
+        assert len(segments) == 7
+        with open(glob(f"{tmp_path}/*.manifest.json")[0], 'r') as f:
+            assert json.load(f)['segments'] == [Path(s).name for s in segments]
+        with h5py.File(segments[-1], 'r') as f:
+            assert f['data'].shape == (2, 5)
+
+        results = _run_test_pipeline(tmp_path)
+
+        np.testing.assert_equal(results.ts.get_state(), [data.reshape((20, 5))])
+        np.testing.assert_equal(results.annot.get_state(), [np.array(_anot).reshape(-1, 1)])
+        np.testing.assert_equal(results.channels.get_state(), [["A", "B", "C", "D", "E"]])
+        np.testing.assert_equal(results.percent.get_state(), [1.0])
+
+    def test_swmr_follow(self, tmp_path):
+        data = np.arange(300, dtype=np.int64).reshape((30, 2, 5))
+
+        write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/", swmr=True, flush_samples=4)
+        write_data._onstart()
+
+        def write():
+            write_data.process(ts=data[0], channels=["A", "B", "C", "D", "E"])
+            for batch in data[1:]:
+                time.sleep(0.01)
+                write_data.process(ts=batch)
+            write_data._onstop()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        results = _run_test_pipeline(tmp_path, follow=True, poll_interval=0.001, follow_timeout=1)
+        writer.join()
+
+        # rows are only sent once, in order
+        np.testing.assert_equal(np.concatenate(results.ts.get_state()), data.reshape((60, 5)))
+        assert len(results.ts.get_state()) > 1
+        np.testing.assert_equal(results.channels.get_state(), [["A", "B", "C", "D", "E"]])
+
+    def test_annotation_runs(self, tmp_path):
+        rng = np.random.default_rng(seed=0)
+        annot = rng.choice(["Stand", "Walk", "Run"], p=[0.8, 0.1, 0.1], size=1000)
+        splits = np.sort(rng.integers(low=0, high=1000, size=50))
+
+        # previous per-sample implementation as reference
+        expected, last = [], (annot[0], 0, 0)
+        for a in annot:
+            if a == last[0]:
+                last = (a, last[1], last[2] + 1)
+            else:
+                expected.append((last[1], last[2], last[0]))
+                last = (a, last[2], last[2] + 1)
+
+        write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/")
+        write_data.annotRuns = []
+        for batch in np.split(annot, splits):
+            write_data.receive_annotation(list(batch))
+
+        assert write_data.annotRuns == expected
+        assert write_data.last_annotation == last
+
+        # runs are written once their samples are flushed, those of multiple flushes are joined
+        write_data.outputFileAnnotation = io.StringIO()
+        for n in np.diff(np.concatenate([[0], splits, [1000]])):
+            write_data._flush_annotation(int(n))
+        write_data._write_runs([write_data.annotOpen])
+
+        assert write_data.outputFileAnnotation.getvalue() == "".join(f"{s},{e},{l}\n" for s, e, l in expected + [(last[1], last[2], last[0])])
+        assert write_data.annotRuns == []
+
+    def test_drop_annotation(self, tmp_path):
+        write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/")
+        write_data.annotRuns = []
+        write_data.outputFileAnnotation = io.StringIO()
+        write_data.receive_annotation(["a"] * 10 + ["b"] * 10 + ["c"] * 5)
+
+        write_data._flush_annotation(5)
+        # drops the end of "a" and the start of "b"
+        write_data._flush_annotation(10, dropped=True)
+        write_data._flush_annotation(10)
+        write_data._write_runs([write_data.annotOpen])
+
+        assert write_data.outputFileAnnotation.getvalue() == "0,5,a\n5,10,b\n10,15,c\n"
+
+    def test_queue_size_invalid(self, tmp_path):
+        with pytest.raises(ValueError):
+            Out_h5_csv(name="C", folder=f"{tmp_path}/", async_write=True, queue_size=0)
@@ -1,13 +1,19 @@
+from types import SimpleNamespace
 from typing import NamedTuple
 import numpy as np
+import asyncio
+import h5py
 import logging
+import time
+import pytest
 
 logging.basicConfig(level=logging.DEBUG)
 
 from livenodes import Graph
 
 from ln_io_h5_csv.out_h5_csv import Out_h5_csv
-from ln_io_h5_csv.in_playback_h5_csv import In_playback_h5_csv
+from ln_io_h5_csv import in_playback_h5_csv
+from ln_io_h5_csv.in_playback_h5_csv import In_playback_h5_csv, _Pacer
 from ln_io_python.out_python import Out_python
 from ln_io_python.in_python import In_python
 
@@ -16,13 +22,14 @@ class Out_nodes(NamedTuple):
     ts: Out_python
     channels: Out_python
     annot: Out_python
+    annot_labels: Out_python
 
 
 # Example annotation includes small 1 and 2 size blocks to test these edge cases.
 _anot = ["1"] * 5 + ["2"] * 2 + ["3"] * 1 + ["1"] * 2 + ["2"] * 3 + ["3"] * 7
 
 
-def _prepare_data(tmp_path, generate_annot=True):
+def _prepare_data(tmp_path, generate_annot=True, **kwargs):
     data = np.arange(100).reshape((1, 20, 5))  # 20 samples with 5 channels each
 
     data_in = In_python(name="A", data=data)
@@ -31,7 +38,7 @@ def _prepare_data(tmp_path, generate_annot=True):
     collect_data = Out_python(name="B")
     collect_data.add_input(data_in, emit_port=data_in.ports_out.any, recv_port=collect_data.ports_in.any)
 
-    write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/")
+    write_data = Out_h5_csv(name="C", folder=f"{tmp_path}/", **kwargs)
     write_data.add_input(data_in, emit_port=data_in.ports_out.any, recv_port=write_data.ports_in.ts)
     write_data.add_input(channels_in, emit_port=channels_in.ports_out.any, recv_port=write_data.ports_in.channels)
 
@@ -47,10 +54,10 @@ def _prepare_data(tmp_path, generate_annot=True):
     return collect_data.get_state()
 
 
-def _run_test_pipeline(tmp_path, emit_at_once, channel_names=None):
+def _run_test_pipeline(tmp_path, emit_at_once, channel_names=None, extension=".h5", **kwargs):
     # Set sample rate very high since we don't want actual real-time simulation here
     read_data = In_playback_h5_csv(
-        name="A", files=f"{tmp_path}/*.h5", loop=False, emit_at_once=emit_at_once, meta={'channels': channel_names, 'sample_rate': 1000000}
+        name="A", files=f"{tmp_path}/*{extension}", loop=False, emit_at_once=emit_at_once, meta={'channels': channel_names, 'sample_rate': 1000000}, **kwargs
     )
 
     collect_data = Out_python(name="B")
@@ -62,15 +69,18 @@ def _run_test_pipeline(tmp_path, emit_at_once, channel_names=None):
     collect_anot = Out_python(name="D")
     collect_anot.add_input(read_data, emit_port=read_data.ports_out.annot, recv_port=collect_anot.ports_in.any)
 
+    collect_labels = Out_python(name="E")
+    collect_labels.add_input(read_data, emit_port=read_data.ports_out.annot_labels, recv_port=collect_labels.ports_in.any)
+
     g = Graph(start_node=read_data)
     g.start_all()
     g.join_all()
     g.stop_all()
 
-    return Out_nodes(collect_data, collect_channels, collect_anot)
+    return Out_nodes(collect_data, collect_channels, collect_anot, collect_labels)
 
 
-def _run_single_test(tmp_path, emit_at_once, exp_data_shape, empty_annot=False, exp_annot_shape=None):
+def _run_single_test(tmp_path, emit_at_once, exp_data_shape, empty_annot=False, exp_annot_shape=None, **kwargs):
     if empty_annot:
         expected_data = np.array(_prepare_data(tmp_path, generate_annot=False)).reshape(exp_data_shape)
         expected_annot = []
@@ -79,7 +89,7 @@ def _run_single_test(tmp_path, emit_at_once, exp_data_shape, empty_annot=False,
         expected_annot = np.array(_anot).reshape(exp_annot_shape)
     channels = ["CH1", "CH2", "CH3", "CH4", "CH5"]
 
-    results = _run_test_pipeline(tmp_path, emit_at_once=emit_at_once, channel_names=channels)
+    results = _run_test_pipeline(tmp_path, emit_at_once=emit_at_once, channel_names=channels, **kwargs)
 
     actual_data = np.array(results.ts.get_state())
     actual_annot = results.annot.get_state()
@@ -107,5 +117,134 @@ class TestProcessing:
     def test_emit_more_than_data(self, tmp_path):  # Should behave the same as data length for emit_at_once
         _run_single_test(tmp_path, emit_at_once=1000, exp_data_shape=(1, 20, 5), exp_annot_shape=(1, 20, 1))
 
+    def test_emit_small_blocks(self, tmp_path):  # Block size is rounded up to 6 samples
+        _run_single_test(tmp_path, emit_at_once=2, exp_data_shape=(10, 2, 5), exp_annot_shape=(10, 2, 1), block_size=5)
+
+    @pytest.mark.parametrize("prefetch", [0, 1])
+    def test_prefetch(self, tmp_path, prefetch):  # Synchronous reads and a single block read ahead
+        _run_single_test(tmp_path, emit_at_once=2, exp_data_shape=(10, 2, 5), exp_annot_shape=(10, 2, 1), block_size=4, prefetch=prefetch)
+
+    @pytest.mark.parametrize("speed", [None, 0, 10])
+    def test_speed(self, tmp_path, speed):  # Unthrottled playback keeps the batching
+        _run_single_test(tmp_path, emit_at_once=5, exp_data_shape=(4, 5, 5), exp_annot_shape=(4, 5, 1), speed=speed)
+
+    @pytest.mark.parametrize("file_format", ["arrow", "parquet"])
+    def test_file_format(self, tmp_path, file_format):
+        expected_data = np.array(_prepare_data(tmp_path, file_format=file_format)).reshape((10, 2, 5))
+
+        results = _run_test_pipeline(tmp_path, emit_at_once=2, extension=f".{file_format}", block_size=6)
+
+        np.testing.assert_equal(np.array(results.ts.get_state()), expected_data)
+        np.testing.assert_equal(results.annot.get_state(), np.array(_anot).reshape((10, 2, 1)))
+        np.testing.assert_equal(results.channels.get_state()[0], ["A", "B", "C", "D", "E"])
+
     def test_annot_empty(self, tmp_path):
         _run_single_test(tmp_path, emit_at_once=1, exp_data_shape=(20, 1, 5), empty_annot=True)
+
+    def test_categorical(self, tmp_path):
+        _prepare_data(tmp_path)
+
+        results = _run_test_pipeline(tmp_path, emit_at_once=5, categorical=True)
+
+        labels = results.annot_labels.get_state()
+        actual_annot = np.array(results.annot.get_state())
+
+        assert len(labels) == 1
+        assert np.issubdtype(actual_annot.dtype, np.integer)
+        np.testing.assert_equal(np.array(labels[0])[actual_annot], np.array(_anot).reshape((4, 5, 1)))
+
+
+    def test_positional(self, tmp_path):  # Settings added later keep the positional order of the original signature
+        read_data = In_playback_h5_csv(f"{tmp_path}/*.h5", {'sample_rate': 100}, False, 5, "Positional", "1")
+
+        assert (read_data.name, read_data.compute_on, read_data.loop, read_data.emit_at_once) == ("Positional", "1", False, 5)
+
+
+class TestPacing:
+
+    def test_no_drift(self, monkeypatch):
+        clock = SimpleNamespace(now=100.0, sleeps=0)
+
+        async def oversleeping(seconds):
+            # each sleep overshoots by 1 ms, e.g. due to scheduling delays
+            clock.sleeps += 1
+            clock.now += seconds + 0.001
+
+        monkeypatch.setattr(in_playback_h5_csv, "time", SimpleNamespace(monotonic=lambda: clock.now))
+        monkeypatch.setattr(in_playback_h5_csv, "asyncio", SimpleNamespace(sleep=oversleeping))
+        pacer = _Pacer(interval=0.002)
+
+        async def run():
+            for _ in range(250):
+                await pacer.wait()
+
+        asyncio.run(run())
+
+        # deadlines are absolute, so sleep overshoot does not add up over the ticks
+        assert clock.now - 100.0 == pytest.approx(0.5 + 0.001)
+        # sleeping once per tick instead of busy-waiting
+        assert clock.sleeps == 250
+        assert pacer.ticks == pacer.waits == 250
+        assert pacer.jitter == pytest.approx(0.001)
+        assert pacer.lateness_max == pytest.approx(0.001)
+
+    def test_jitter_logged(self, tmp_path, caplog):
+        with h5py.File(f"{tmp_path}/data.h5", 'w') as f:
+            f.create_dataset("data", data=np.arange(40).reshape((20, 2)))
+
+        read_data = In_playback_h5_csv(files=f"{tmp_path}/*.h5", meta={'sample_rate': 1000}, loop=True, emit_at_once=10, prefetch=0)
+
+        async def run():
+            batches = 0
+            async for _ in read_data._async_run():
+                batches += 1
+                if batches == 5:
+                    break
+
+        caplog.set_level(logging.INFO, logger="livenodes")
+        asyncio.run(run())
+        # looped playback never ends by itself, jitter is thus logged after each file
+        assert [r.message.split(' over ')[1] for r in caplog.records if 'Playback jitter' in r.message] == ["2 batches"] * 2
+
+        caplog.clear()
+        read_data.finished_event.set()
+        read_data._onstop()
+        assert [r.message.split(' over ')[1] for r in caplog.records if 'Playback jitter' in r.message] == ["1 batches"]
+
+    @pytest.mark.parametrize("block_size", [4096, 10, 25])
+    @pytest.mark.parametrize("catch_up", ["coalesce", "drop"])
+    def test_catch_up(self, tmp_path, catch_up, block_size, caplog):
+        with h5py.File(f"{tmp_path}/data.h5", 'w') as f:
+            f.create_dataset("data", data=np.arange(2000).reshape((1000, 2)))
+
+        read_data = In_playback_h5_csv(
+            files=f"{tmp_path}/*.h5", meta={'sample_rate': 1000}, loop=False, emit_at_once=10, block_size=block_size, prefetch=0, catch_up=catch_up, max_lag=2
+        )
+
+        async def run():
+            batches, warnings = [], None
+            async for result in read_data._async_run():
+                batches.append(result['ts'])
+                if len(batches) == 5:
+                    # slow downstream, falls ~10 batches behind
+                    time.sleep(0.1)
+                if len(batches) == 6:
+                    warnings = [r.message for r in caplog.records if r.levelno == logging.WARNING]
+            return batches, warnings
+
+        caplog.set_level(logging.INFO, logger="livenodes")
+        batches, warnings = asyncio.run(run())
+        sizes = [len(batch) for batch in batches]
+
+        # warned as soon as playback falls behind, the samples caught up once the file ends
+        assert len(warnings) == 1 and "behind schedule" in warnings[0]
+        assert len([r for r in caplog.records if "Behind schedule" in r.message]) == 1
+
+        assert sizes[:5] == [10] * 5
+        if catch_up == "coalesce":
+            assert sizes[5] > 10 * 3
+            np.testing.assert_equal(np.concatenate(batches), np.arange(2000).reshape((1000, 2)))
+        else:
+            assert set(sizes) == {10}
+            assert sum(sizes) < 1000 - 10 * 2
+            assert batches[5][0, 0] > 2 * 10 * 3
@@ -0,0 +1,168 @@
+from typing import NamedTuple
+import glob
+import numpy as np
+import h5py
+import pytest
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+from livenodes import Graph
+
+from ln_io_h5_csv.abstract_in_h5_csv import Abstract_in_h5_csv
+from ln_io_h5_csv.in_window_h5_csv import In_window_h5_csv
+from ln_io_python.out_python import Out_python
+
+
+class Out_nodes(NamedTuple):
+    ts: Out_python
+    channels: Out_python
+    annot: Out_python
+
+
+def _prepare_data(tmp_path):
+    # each sample holds its recording index in the first and its sample index in the second channel
+    for i, n_samples in enumerate([20, 50, 200]):
+        with h5py.File(f"{tmp_path}/rec{i}.h5", 'w') as f:
+            f.create_dataset("data", data=np.stack([np.full(n_samples, i), np.arange(n_samples), np.zeros(n_samples)], axis=1))
+        with open(f"{tmp_path}/rec{i}.csv", 'w') as f:
+            # short "Rare" run at the start of each recording, "Common" for the rest
+            f.write(f"start,end,act\n0,10,Rare\n10,{n_samples},Common\n")
+
+
+def _run_test_pipeline(tmp_path, **kwargs):
+    read_data = In_window_h5_csv(name="A", files=f"{tmp_path}/*.h5", meta={'channels': ["Rec", "Sample", "Zero"]}, **kwargs)
+
+    collect_data = Out_python(name="B")
+    collect_data.add_input(read_data, emit_port=read_data.ports_out.ts, recv_port=collect_data.ports_in.any)
+
+    collect_channels = Out_python(name="C")
+    collect_channels.add_input(read_data, emit_port=read_data.ports_out.channels, recv_port=collect_channels.ports_in.any)
+
+    collect_annot = Out_python(name="D")
+    collect_annot.add_input(read_data, emit_port=read_data.ports_out.annot, recv_port=collect_annot.ports_in.any)
+
+    g = Graph(start_node=read_data)
+    g.start_all()
+    g.join_all()
+    g.stop_all()
+
+    return Out_nodes(collect_data, collect_channels, collect_annot)
+
+
+class TestProcessing:
+
+    @pytest.mark.parametrize("prefetch", [0, 4])
+    def test_windows(self, tmp_path, prefetch):
+        _prepare_data(tmp_path)
+
+        results = _run_test_pipeline(tmp_path, window=15, batch_size=8, n_batches=5, seed=0, prefetch=prefetch)
+
+        actual_data = results.ts.get_state()
+        actual_annot = results.annot.get_state()
+        assert len(actual_data) == 5
+        assert all(ts.shape == (8, 15, 3) for ts in actual_data)
+        assert all(annot.shape == (8, 15, 1) for annot in actual_annot)
+        np.testing.assert_equal(results.channels.get_state()[0], ["Rec", "Sample", "Zero"])
+
+        windows = np.concatenate(actual_data)
+        # windows are contiguous samples of a single recording
+        assert np.all(windows[:, :, 0] == windows[:, :1, 0])
+        assert np.all(np.diff(windows[:, :, 1], axis=1) == 1)
+        assert np.all(windows[:, -1, 1] < np.array([20, 50, 200])[windows[:, 0, 0].astype(int)])
+        # annotation matches the samples of each window
+        np.testing.assert_equal(np.concatenate(actual_annot)[:, :, 0], np.where(windows[:, :, 1] < 10, "Rare", "Common"))
+
+    def test_reads(self, tmp_path, monkeypatch):
+        _prepare_data(tmp_path)
+        annotation_reads, data_reads = [], []
+        read_annotation_runs = Abstract_in_h5_csv._read_annotation_runs
+        open_data = Abstract_in_h5_csv._open_data.__func__
+
+        def counting_read_annotation_runs(f, data_file):
+            annotation_reads.append(f)
+            return read_annotation_runs(f, data_file)
+
+        def counting_open_data(cls, f, columns=None, rows=None, annotation=True):
+            data_reads.append(rows)
+            return open_data(cls, f, columns, rows, annotation)
+
+        monkeypatch.setattr(Abstract_in_h5_csv, "_read_annotation_runs", staticmethod(counting_read_annotation_runs))
+        monkeypatch.setattr(Abstract_in_h5_csv, "_open_data", classmethod(counting_open_data))
+        results = _run_test_pipeline(tmp_path, window=15, batch_size=8, n_batches=5, seed=0, prefetch=0, select_start=2)
+
+        # annotation is read once per recording, windows only read their own rows
+        assert sorted(annotation_reads) == sorted(glob.glob(f"{tmp_path}/*.h5"))
+        assert all(stop - start == 15 for start, stop in data_reads[3:])
+        windows = np.concatenate(results.ts.get_state())
+        assert np.all(windows[:, 0, 1] >= 2)
+        np.testing.assert_equal(np.concatenate(results.annot.get_state())[:, :, 0], np.where(windows[:, :, 1] < 10, "Rare", "Common"))
+
+    def test_segments(self, tmp_path):
+        # a single recording split into segments, each sample holds its index within the recording
+        segments = [f"{tmp_path}/rec.part{i:04d}.h5" for i in range(3)]
+        for i, f in enumerate(segments):
+            with h5py.File(f, 'w') as data_file:
+                data_file.create_dataset("data", data=np.arange(10 * i, 10 * i + 10).reshape(-1, 1))
+
+        node = In_window_h5_csv(files=f"{tmp_path}/*.h5", window=8, select_start=3, select_stop=27)
+        layout = node._recording_layout(segments)
+
+        np.testing.assert_equal(layout[1], [0, 7, 17, 24])
+        # windows span segments
+        for start in [0, 5, 16]:
+            data, _, annot = node._read_window(segments, layout, start)
+            np.testing.assert_equal(data[:, 0], np.arange(3 + start, 3 + start + 8))
+            assert len(annot) == 0
+
+    def test_seed(self, tmp_path):
+        _prepare_data(tmp_path)
+
+        first = _run_test_pipeline(tmp_path, window=5, batch_size=4, n_batches=3, seed=42).ts.get_state()
+        second = _run_test_pipeline(tmp_path, window=5, batch_size=4, n_batches=3, seed=42).ts.get_state()
+        other = _run_test_pipeline(tmp_path, window=5, batch_size=4, n_batches=3, seed=7).ts.get_state()
+
+        np.testing.assert_equal(first, second)
+        assert not np.array_equal(first, other)
+
+    def test_stratify(self, tmp_path):
+        _prepare_data(tmp_path)
+        node = In_window_h5_csv(files=f"{tmp_path}/*.h5", window=10, stratify=True)
+        recordings = node._glob_recordings()
+
+        recs, firsts, positions, p = node._window_candidates([node._recording_layout(segments) for segments in recordings])
+
+        # the "Rare" runs fit a single window each, but are sampled as often as all "Common" windows together
+        rare = firsts == 0
+        np.testing.assert_equal(positions[rare], [1, 1, 1])
+        np.testing.assert_allclose(p[rare].sum(), 0.5)
+        np.testing.assert_allclose(p.sum(), 1)
+
+        results = _run_test_pipeline(tmp_path, window=10, batch_size=50, n_batches=4, seed=0, stratify=True)
+
+        labels = np.concatenate(results.annot.get_state())[:, :, 0]
+        # windows lie within a single run
+        assert np.all(labels == labels[:, :1])
+        assert 0.35 < np.mean(labels[:, 0] == "Rare") < 0.65
+
+    def test_uniform(self, tmp_path):
+        _prepare_data(tmp_path)
+        node = In_window_h5_csv(files=f"{tmp_path}/*.h5", window=20)
+        recordings = node._glob_recordings()
+
+        recs, firsts, positions, p = node._window_candidates([node._recording_layout(segments) for segments in recordings])
+
+        # recordings are sampled proportionally to their number of window positions
+        np.testing.assert_equal(sorted(positions), [1, 31, 181])
+        np.testing.assert_allclose(p, positions / 213)
+
+    def test_window_too_long(self, tmp_path):
+        _prepare_data(tmp_path)
+
+        node = In_window_h5_csv(files=f"{tmp_path}/*.h5", window=201)
+        recordings = node._glob_recordings()
+        with pytest.raises(ValueError):
+            node._window_candidates([node._recording_layout(segments) for segments in recordings])
+
+        with pytest.raises(ValueError):
+            In_window_h5_csv(files=f"{tmp_path}/*.h5", window=0)